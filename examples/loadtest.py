@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+
+"""A load generator for Sijax applications.
+
+It simulates many browsers calling a Sijax function at the same time
+(using asyncio, over plain HTTP connections) and reports the throughput,
+the latency histogram and - for streaming functions - how many streams
+were open at once and how much server memory each of them took.
+
+The application is either started locally (in another process,
+using Werkzeug's threaded server) from a Python file::
+
+    python examples/loadtest.py --app examples/hello.py --path /sijax \\
+        --function say_hello --args '["me", "you"]' --clients 50
+
+    python examples/loadtest.py --app examples/comet.py \\
+        --mode comet --function do_work --args '[1]' --clients 200
+
+    python examples/loadtest.py --app examples/upload.py \\
+        --mode upload --form-id formOne --field message=hi --file-size 65536
+
+or is already running (its memory is only measured if its process id is given)::
+
+    python examples/loadtest.py --url http://127.0.0.1:8000/ --server-pid 1234 ...
+
+Only the standard library is needed. Memory is measured on Linux only.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode, urlsplit
+
+
+#: The request parameters of the Sijax protocol
+PARAM_REQUEST = 'sijax_rq'
+PARAM_ARGS = 'sijax_args'
+
+#: What each flush of a streaming (Comet/Upload) response contains
+STREAM_FLUSH_MARKER = b'<script type="text/javascript">'
+
+#: What the default Sijax error handlers (unknown function, bad arguments,
+#: timeout) put in their alerts
+SIJAX_ERROR_MARKER = b'(Sijax error)'
+
+#: The command the default "busy" handler sends, when limits reject the call
+SIJAX_BUSY_MARKER = b'Sijax.busy'
+
+#: Upper bounds (in milliseconds) of the latency histogram buckets
+HISTOGRAM_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+SERVER_CODE = '''
+import logging, runpy, sys
+from werkzeug.serving import run_simple
+
+path, name, host, port = sys.argv[1:5]
+app = runpy.run_path(path, run_name='loadtest_app')[name]
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
+run_simple(host, int(port), app, threaded=True)
+'''
+
+
+class Stats(object):
+    """What the simulated clients have measured."""
+
+    def __init__(self):
+        self.completed = 0
+        self.failed = 0
+        self.errors = {}
+        self.flushes = 0
+        #: Calls rejected by the limits of the function (see `max_concurrent` and `rate`)
+        self.busy = 0
+        self.received_bytes = 0
+        #: Seconds until the response (or its first flush) arrived
+        self.first_byte_latencies = []
+        #: Seconds until the response was complete
+        self.latencies = []
+        self.open_streams = 0
+        #: (time, open streams, server RSS in bytes or None)
+        self.samples = []
+
+    def add_error(self, error):
+        self.failed += 1
+        key = str(error) or error.__class__.__name__
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+
+def encode_multipart(fields, files):
+    boundary = '----sijaxloadtest%d' % int(time.time() * 1000)
+    parts = []
+    for name, value in fields:
+        parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                      % (boundary, name, value)).encode('utf-8'))
+    for name, filename, content in files:
+        parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                      'Content-Type: application/octet-stream\r\n\r\n'
+                      % (boundary, name, filename)).encode('utf-8'))
+        parts.append(content + b'\r\n')
+    parts.append(('--%s--\r\n' % boundary).encode('utf-8'))
+    return b''.join(parts), 'multipart/form-data; boundary=%s' % boundary
+
+
+def build_request_body(options):
+    """Returns the body and content type of the request, as sent by the Sijax javascript."""
+    if options.mode == 'upload':
+        fields = [(PARAM_REQUEST, '%s_upload' % options.form_id),
+                  (PARAM_ARGS, json.dumps([options.form_id]))]
+        fields.extend(field.split('=', 1) for field in options.field)
+        files = []
+        if options.file_size:
+            files.append(('file', 'file.bin', os.urandom(options.file_size)))
+        return encode_multipart(fields, files)
+
+    data = [(PARAM_REQUEST, options.function), (PARAM_ARGS, options.args)]
+    data.extend(field.split('=', 1) for field in options.field)
+    return urlencode(data).encode('utf-8'), 'application/x-www-form-urlencoded'
+
+
+async def read_body(reader, headers, on_data):
+    """Reads the response body, passing each piece of it to ``on_data``."""
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                return
+            on_data(await reader.readexactly(size))
+            await reader.readline()
+    elif 'content-length' in headers:
+        remaining = int(headers['content-length'])
+        while remaining > 0:
+            data = await reader.read(min(remaining, 65536))
+            if not data:
+                raise ConnectionError('connection closed before the end of the response')
+            remaining -= len(data)
+            on_data(data)
+    else:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            on_data(data)
+
+
+async def make_call(target, body, content_type, options, stats):
+    host, port, path = target
+    streaming = options.mode != 'call'
+    started = time.time()
+    first_byte_at = [None]
+    received = []
+
+    def on_data(data):
+        if first_byte_at[0] is None:
+            first_byte_at[0] = time.time()
+        received.append(data)
+        stats.received_bytes += len(data)
+        if streaming:
+            stats.flushes += data.count(STREAM_FLUSH_MARKER)
+
+    reader, writer = await asyncio.open_connection(host, port)
+    stream_opened = False
+    try:
+        writer.write(('POST %s HTTP/1.1\r\nHost: %s:%d\r\nContent-Type: %s\r\n'
+                      'Content-Length: %d\r\nConnection: close\r\n\r\n'
+                      % (path, host, port, content_type, len(body))).encode('latin-1') + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed without a response')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if streaming:
+            stream_opened = True
+            stats.open_streams += 1
+        await read_body(reader, headers, on_data)
+    finally:
+        if stream_opened:
+            stats.open_streams -= 1
+        writer.close()
+
+    if status != 200:
+        raise ValueError('HTTP %d' % status)
+    content = b''.join(received)
+    if streaming:
+        if STREAM_FLUSH_MARKER not in content:
+            raise ValueError('no commands streamed')
+    else:
+        commands = json.loads(content.decode('utf-8'))
+        if not isinstance(commands, list):
+            raise ValueError('not a list of commands')
+    if SIJAX_ERROR_MARKER in content:
+        raise ValueError('Sijax error alert')
+    if SIJAX_BUSY_MARKER in content:
+        stats.busy += 1
+
+    finished = time.time()
+    stats.first_byte_latencies.append((first_byte_at[0] or finished) - started)
+    stats.latencies.append(finished - started)
+    stats.completed += 1
+
+
+async def simulate_client(target, body, content_type, options, stats, deadline):
+    while time.time() < deadline:
+        try:
+            await asyncio.wait_for(make_call(target, body, content_type, options, stats),
+                                   options.timeout)
+        except asyncio.TimeoutError:
+            stats.add_error('timed out')
+        except (OSError, ValueError) as e:
+            stats.add_error(e)
+        if options.think_time:
+            await asyncio.sleep(options.think_time)
+
+
+def get_rss(pid):
+    """Returns the resident memory of the process (in bytes), or None if unknown."""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+async def sample(stats, server_pid, interval):
+    while True:
+        rss = get_rss(server_pid) if server_pid else None
+        stats.samples.append((time.time(), stats.open_streams, rss))
+        await asyncio.sleep(interval)
+
+
+async def run_load(target, options, server_pid):
+    body, content_type = build_request_body(options)
+    stats = Stats()
+
+    # Warm up (and make sure that the function can be called at all)
+    try:
+        await make_call(target, body, content_type, options, stats)
+    except (OSError, ValueError) as e:
+        raise SystemExit('The first call failed: %s' % (str(e) or e.__class__.__name__))
+    baseline_rss = get_rss(server_pid) if server_pid else None
+    stats = Stats()
+
+    sampler = asyncio.ensure_future(sample(stats, server_pid, 0.1))
+    started = time.time()
+    deadline = started + options.duration
+    clients = []
+    for i in range(options.clients):
+        clients.append(asyncio.ensure_future(
+            simulate_client(target, body, content_type, options, stats, deadline)))
+        if options.ramp_up:
+            await asyncio.sleep(options.ramp_up / options.clients)
+    await asyncio.gather(*clients)
+    elapsed = time.time() - started
+    sampler.cancel()
+    return stats, elapsed, baseline_rss
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def format_histogram(latencies, width=40):
+    counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+    for latency in latencies:
+        ms = latency * 1000
+        for index, bound in enumerate(HISTOGRAM_BUCKETS):
+            if ms <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[-1] += 1
+
+    lines = []
+    most = max(counts) or 1
+    labels = ['<= %d ms' % bound for bound in HISTOGRAM_BUCKETS] + ['>  %d ms' % HISTOGRAM_BUCKETS[-1]]
+    for label, count in zip(labels, counts):
+        if count:
+            lines.append('  %12s %7d %s' % (label, count, '#' * max(1, count * width // most)))
+    return '\n'.join(lines)
+
+
+def format_latencies(title, latencies):
+    ms = [latency * 1000 for latency in latencies]
+    return ('%s: p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms\n%s'
+            % (title, percentile(ms, 0.5), percentile(ms, 0.9), percentile(ms, 0.99),
+               max(ms) if ms else 0, format_histogram(latencies)))
+
+
+def format_bytes(count):
+    for unit in ('B', 'KB', 'MB'):
+        if abs(count) < 1024:
+            return '%.1f %s' % (count, unit)
+        count /= 1024.0
+    return '%.1f GB' % count
+
+
+def report(stats, elapsed, baseline_rss, options):
+    lines = ['%d clients, %.1f s, %s mode' % (options.clients, elapsed, options.mode),
+             'Completed calls: %d (%.1f/s), rejected as busy: %d, failed: %d'
+             % (stats.completed, stats.completed / elapsed, stats.busy, stats.failed)]
+    for error, count in sorted(stats.errors.items(), key=lambda item: -item[1]):
+        lines.append('  %6d x %s' % (count, error))
+    lines.append('Received: %s (%s/s)' % (format_bytes(stats.received_bytes),
+                                        format_bytes(stats.received_bytes / elapsed)))
+
+    if options.mode != 'call':
+        open_streams = [open_count for _, open_count, _ in stats.samples]
+        lines.append('Flushes: %d (%.1f/s)' % (stats.flushes, stats.flushes / elapsed))
+        lines.append('Open streams: peak %d, mean %.1f'
+                     % (max(open_streams or [0]),
+                        sum(open_streams) / float(len(open_streams) or 1)))
+        lines.append(format_latencies('Time to first flush', stats.first_byte_latencies))
+    lines.append(format_latencies('Time to complete', stats.latencies))
+
+    rss_samples = [(open_count, rss) for _, open_count, rss in stats.samples if rss is not None]
+    if baseline_rss is not None and rss_samples:
+        peak_rss = max(rss for _, rss in rss_samples)
+        lines.append('Server memory: %s before, %s at peak'
+                     % (format_bytes(baseline_rss), format_bytes(peak_rss)))
+        # The memory growth while the most streams were open, per stream
+        peak_open, rss_at_peak_open = max(rss_samples)
+        if options.mode != 'call' and peak_open:
+            lines.append('Memory per open stream: ~%s'
+                         % format_bytes((rss_at_peak_open - baseline_rss) / float(peak_open)))
+    return '\n'.join(lines)
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_app(app_spec, host):
+    """Starts the application (``path/to/file.py[:name]``) in another process."""
+    path, _, name = app_spec.partition(':')
+    port = get_free_port()
+    process = subprocess.Popen([sys.executable, '-c', SERVER_CODE, path, name or 'app', host, str(port)])
+
+    give_up_at = time.time() + 15
+    while time.time() < give_up_at:
+        if process.poll() is not None:
+            raise SystemExit('The application failed to start.')
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise SystemExit('The application did not start listening in time.')
+
+
+def parse_options(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--app', help='path/to/app.py[:name] - starts the app locally')
+    target.add_argument('--url', help='the URL of an already running app')
+    parser.add_argument('--path', default='/', help='the URL path of the Sijax-enabled page')
+    parser.add_argument('--server-pid', type=int, help='process id of the --url app, for memory stats')
+    parser.add_argument('--mode', choices=('call', 'comet', 'upload'), default='call')
+    parser.add_argument('--function', help='the public name of the function to call')
+    parser.add_argument('--args', default='[]', help='the arguments (a JSON array)')
+    parser.add_argument('--form-id', help='the form id, for uploads')
+    parser.add_argument('--field', action='append', default=[],
+                        help='an additional name=value form field (repeatable)')
+    parser.add_argument('--file-size', type=int, default=0, help='the size of the uploaded file')
+    parser.add_argument('--clients', type=int, default=10, help='concurrent simulated clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run for')
+    parser.add_argument('--ramp-up', type=float, default=0, help='seconds to start all clients over')
+    parser.add_argument('--think-time', type=float, default=0, help='seconds between calls of a client')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds a single call may take')
+    options = parser.parse_args(argv)
+
+    if options.mode == 'upload' and not options.form_id:
+        parser.error('--form-id is required for uploads')
+    if options.mode != 'upload' and not options.function:
+        parser.error('--function is required')
+    if not isinstance(json.loads(options.args), list):
+        parser.error('--args needs to be a JSON array')
+    return options
+
+
+def main(argv=None):
+    options = parse_options(argv)
+
+    process = None
+    if options.app:
+        host = '127.0.0.1'
+        process, port = start_app(options.app, host)
+        path = options.path
+        server_pid = process.pid
+    else:
+        url = urlsplit(options.url)
+        host, port = url.hostname, url.port or 80
+        path = (url.path or '/') + ('?' + url.query if url.query else '')
+        server_pid = options.server_pid
+
+    try:
+        stats, elapsed, baseline_rss = asyncio.run(run_load((host, port, path), options, server_pid))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    print(report(stats, elapsed, baseline_rss, options))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,2026 @@
 
 from __future__ import absolute_import
 
-from werkzeug.wsgi import ClosingIterator
+import asyncio
+import bisect
+import concurrent.futures
+import contextvars
+import copy
+import cProfile
+import functools
+import gzip
+import hashlib
+import hmac
+import inspect
+import io
+import marshal
+import mmap
+import os
+import pstats
+import random
+import re
+import struct
+import threading
+import time
+import types
+import typing
+import weakref
+from collections import OrderedDict, deque
+from functools import lru_cache, wraps
+from importlib.util import find_spec
+from types import GeneratorType
+from urllib.parse import quote
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+import click
+from flask import (abort, Blueprint, current_app, g, has_app_context, has_request_context,
+                   jsonify, render_template, request, Response, url_for)
+from flask.cli import AppGroup
+from flask.globals import request_ctx
+from werkzeug.local import LocalProxy
+
+# Sijax (and its plugins, which it always imports) is imported
+# when first needed, instead of here, to keep startup fast.
+
+
+#: The request parameter through which the browser reports
+#: the rendered fragments it holds (see :meth:`Sijax.render_fragment`)
+PARAM_FRAGMENTS = 'sijax_fragments'
+
+#: The request parameter carrying the idempotency key of a call,
+#: which stays the same when the call is retried
+#: (see ``SIJAX_IDEMPOTENCY_TTL``)
+PARAM_IDEMPOTENCY_KEY = 'sijax_key'
+
+#: Client-side helpers that :meth:`Sijax.get_js` adds to every page.
+#:
+#: ``Sijax.busy`` is what the default "busy" event handler calls
+#: (see :attr:`Sijax.EVENT_BUSY`). It retries the call after the delay
+#: suggested by the server, backing off exponentially (with jitter)
+#: while the same function keeps getting rejected.
+#:
+#: ``Sijax.fragment`` puts a fragment sent by :meth:`Sijax.render_fragment`
+#: on the page and keeps the last few of them, so that the server can refer
+#: to those by version only. ``Sijax.request`` is wrapped to report them.
+#:
+#: ``Sijax.invalidArgs`` is what the default "invalid arguments" event
+#: handler calls (see :attr:`Sijax.EVENT_INVALID_ARGS`).
+#:
+#: ``Sijax.request`` is also wrapped to give each call a new idempotency key,
+#: unless one is already among the ``data`` of its params (as it is
+#: for the retries made by ``Sijax.busy``). The params are copied,
+#: so the caller's object never gets a key.
+#:
+#: ``Sijax.patchList`` applies the changes computed by :class:`KeyedList`.
+_CLIENT_JS = (
+    'if(!Sijax.busy){Sijax.busyAttempts={};'
+    'Sijax.busy=function(name,args,delay,mode,key){'
+    'var now=new Date().getTime(),a=Sijax.busyAttempts[name];'
+    'if(!a||now-a.last>60000){a=Sijax.busyAttempts[name]={count:0};}'
+    'a.count+=1;a.last=now;'
+    'if(a.count>6){delete Sijax.busyAttempts[name];return;}'
+    'delay=delay*Math.pow(2,a.count-1)*(0.5+Math.random()/2);'
+    'window.setTimeout(function(){'
+    'if(mode==="upload"){jQuery("#"+args[0]).submit();}'
+    'else if(mode==="comet"){sjxComet.request(name,args);}'
+    'else if(key){Sijax.request(name,args,{data:{' + PARAM_IDEMPOTENCY_KEY + ':key}});}'
+    'else{Sijax.request(name,args);}},delay);};}'
+    'if(!Sijax.fragment){Sijax.fragments={};Sijax.fragmentVersions=[];'
+    'Sijax.fragment=function(selector,html,version){'
+    'if(html===null){html=Sijax.fragments[version];if(html===undefined){return;}}'
+    'else if(!(version in Sijax.fragments)){Sijax.fragmentVersions.push(version);'
+    'if(Sijax.fragmentVersions.length>50){'
+    'delete Sijax.fragments[Sijax.fragmentVersions.shift()];}}'
+    'Sijax.fragments[version]=html;jQuery(selector).html(html);};'
+    'Sijax.requestWithoutFragments=Sijax.request;'
+    'Sijax.request=function(name,args,params){'
+    'params=params||{};params.data=params.data||{};'
+    'params.data.' + PARAM_FRAGMENTS + '=Sijax.fragmentVersions.join(",");'
+    'return Sijax.requestWithoutFragments(name,args,params);};}'
+    'if(!Sijax.requestKey){Sijax.requestKey=function(){'
+    'var c=window.crypto,b,i,key="";'
+    'if(c&&c.getRandomValues){b=c.getRandomValues(new Uint8Array(16));'
+    'for(i=0;i<b.length;i+=1){key+=(b[i]+256).toString(16).slice(1);}return key;}'
+    'return new Date().getTime().toString(36)+'
+    'Math.random().toString(36).slice(2)+Math.random().toString(36).slice(2);};'
+    'Sijax.requestWithoutKey=Sijax.request;'
+    'Sijax.request=function(name,args,params){'
+    'params=jQuery.extend({},params);params.data=jQuery.extend({},params.data);'
+    'if(!params.data.' + PARAM_IDEMPOTENCY_KEY + '){'
+    'params.data.' + PARAM_IDEMPOTENCY_KEY + '=Sijax.requestKey();}'
+    'return Sijax.requestWithoutKey(name,args,params);};}'
+    'if(!Sijax.invalidArgs){Sijax.invalidArgs=function(name,errors){'
+    'if(window.console){console.error("Sijax: invalid arguments for "+name,errors);}'
+    'alert("You tried to perform an action in a wrong way! (Sijax error)");};}'
+    'if(!Sijax.patchList){Sijax.patchList=function(selector,ops){'
+    'var $c=jQuery(selector),'
+    'find=function(k){return $c.children().filter(function(){'
+    'return jQuery(this).attr("data-sijax-key")===k;});},'
+    'make=function(k,h){return jQuery(jQuery.trim(h)).attr("data-sijax-key",k);},'
+    'place=function($e,after){if(after===null){$c.prepend($e);}else{find(after).after($e);}};'
+    'jQuery.each(ops,function(i,op){var t=op[0];'
+    'if(t==="reset"){$c.empty();'
+    'jQuery.each(op[1],function(j,item){$c.append(make(item[0],item[1]));});}'
+    'else if(t==="remove"){find(op[1]).remove();}'
+    'else if(t==="update"){find(op[1]).replaceWith(make(op[1],op[2]));}'
+    'else if(t==="insert"){place(make(op[1],op[2]),op[3]);}'
+    'else if(t==="move"){place(find(op[1]).detach(),op[2]);}});};}'
+)
+
+
+class LimitStore(object):
+    """Base class for the counter stores that enforce callback limits
+    (see the ``max_concurrent`` and ``rate`` options of
+    :meth:`Sijax.register_callback`).
+
+    Limits are only enforced across processes if they share the store,
+    so implement this on top of something like Redis when serving
+    the application with several processes (see ``SIJAX_LIMIT_STORE``).
+    """
+
+    def acquire(self, key, limit):
+        """Takes one of the ``limit`` slots available for ``key``.
+
+        :return: ``True`` if a slot was taken, ``False`` if all are in use
+        """
+        raise NotImplementedError
+
+    def release(self, key, limit):
+        """Gives back a slot previously taken with :meth:`acquire`."""
+        raise NotImplementedError
+
+    def incr(self, key, expires):
+        """Increments the counter for ``key`` and returns the new value.
+
+        Counters start from zero and are discarded ``expires`` seconds
+        after they were created.
+        """
+        raise NotImplementedError
+
+
+class LocalLimitStore(LimitStore):
+    """A :class:`LimitStore` that keeps everything in the current process.
+
+    Concurrency slots are backed by semaphores, rate counters by a dictionary.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._counters = {}
+
+    def _get_semaphore(self, key, limit):
+        with self._lock:
+            semaphore = self._semaphores.get((key, limit))
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(limit)
+                self._semaphores[(key, limit)] = semaphore
+            return semaphore
+
+    def acquire(self, key, limit):
+        return self._get_semaphore(key, limit).acquire(False)
+
+    def release(self, key, limit):
+        self._get_semaphore(key, limit).release()
+
+    def incr(self, key, expires):
+        now = time.time()
+        with self._lock:
+            value, expires_at = self._counters.get(key, (0, None))
+            if expires_at is None or expires_at <= now:
+                # Drop all expired counters while we're at it,
+                # so that old rate windows don't pile up
+                for k in [k for k, v in self._counters.items() if v[1] <= now]:
+                    del self._counters[k]
+                value, expires_at = 0, now + expires
+            value += 1
+            self._counters[key] = (value, expires_at)
+            return value
+
+
+class IdempotencyStore(object):
+    """Base class for the stores that keep the responses of calls
+    made with an idempotency key (see ``SIJAX_IDEMPOTENCY_TTL``),
+    so that retried calls get the same response, instead of
+    running the function again.
+
+    Values are the JSON responses, as strings. While a call is
+    still being processed, its key is set to an empty string.
+
+    Retries only get the original response if they reach a process
+    sharing the store with it (see ``SIJAX_IDEMPOTENCY_STORE``).
+    """
+
+    def add(self, key, value, ttl):
+        """Sets the value of ``key`` for ``ttl`` seconds,
+        unless the key is already set.
+
+        :return: ``True`` if the value was set, ``False`` otherwise
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        """Sets the value of ``key`` for ``ttl`` seconds."""
+        raise NotImplementedError
+
+    def get(self, key):
+        """Returns the value of ``key``, or ``None`` if it's not set."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Removes ``key`` from the store, if it's there."""
+        raise NotImplementedError
+
+    def wait(self, key, timeout):
+        """Waits up to ``timeout`` seconds for the call ``key`` belongs to
+        to finish and returns the value of ``key`` then
+        (the same as :meth:`get` would).
+
+        The default implementation polls with :meth:`get`.
+        """
+        deadline = time.time() + timeout
+        while True:
+            value = self.get(key)
+            if value != '' or time.time() >= deadline:
+                return value
+            time.sleep(0.05)
+
+
+class LocalIdempotencyStore(IdempotencyStore):
+    """An :class:`IdempotencyStore` that keeps everything in the current process.
+
+    This is what's used if ``SIJAX_IDEMPOTENCY_STORE`` is not set.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._values = {}
+        self._next_purge = 0
+
+    def _get(self, key, now):
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            del self._values[key]
+            return None
+        return entry[0]
+
+    def _set(self, key, value, ttl, now):
+        if now >= self._next_purge:
+            # Drop all expired values every now and then,
+            # so that keys nobody asks for again don't pile up
+            for k in [k for k, v in self._values.items() if v[1] <= now]:
+                del self._values[k]
+            self._next_purge = now + 60
+        self._values[key] = (value, now + ttl)
+        self._condition.notify_all()
+
+    def add(self, key, value, ttl):
+        now = time.time()
+        with self._condition:
+            if self._get(key, now) is not None:
+                return False
+            self._set(key, value, ttl, now)
+            return True
+
+    def set(self, key, value, ttl):
+        with self._condition:
+            self._set(key, value, ttl, time.time())
+
+    def get(self, key):
+        with self._condition:
+            return self._get(key, time.time())
+
+    def delete(self, key):
+        with self._condition:
+            self._values.pop(key, None)
+            self._condition.notify_all()
+
+    def wait(self, key, timeout):
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                now = time.time()
+                value = self._get(key, now)
+                if value != '' or now >= deadline:
+                    return value
+                self._condition.wait(deadline - now)
+
+
+class SharedMemoryCache(IdempotencyStore):
+    """A cache kept in a memory-mapped file, shared by all the processes
+    (of all the applications) on a machine which use the same ``path``,
+    without needing any external service.
+
+    It can be used as the ``SIJAX_FRAGMENT_CACHE`` (see
+    :meth:`Sijax.render_fragment`) and as the ``SIJAX_IDEMPOTENCY_STORE``,
+    so that all the workers of a preforking server share their hits
+    and the memory is paid for once::
+
+        cache = flask_sijax.SharedMemoryCache('/dev/shm/myapp-sijax')
+        app.config['SIJAX_FRAGMENT_CACHE'] = cache
+        app.config['SIJAX_IDEMPOTENCY_STORE'] = cache
+
+    Keys may be strings, numbers or tuples of those. Values may be anything
+    :mod:`marshal` supports (the same, along with lists and dictionaries).
+    Entries are kept in sets of ``ways`` slots (picked by a hash of the key)
+    and the least recently used entry of a set gets replaced when it's full,
+    so entries may get evicted before the cache is completely full.
+    The markers of calls still being processed (see :class:`IdempotencyStore`)
+    are never evicted. If a set only holds those, :meth:`add` doesn't keep
+    the new value, but still returns ``True``, so that the call isn't held up.
+    Values larger than ``max_value_size`` (once serialized) are not cached.
+
+    The file takes ``max_entries * max_value_size`` bytes (plus a little), so put it on
+    a memory-backed filesystem (like ``/dev/shm``). It's replaced by a new one if it was
+    created with different sizes (or by another version), so all processes need to use
+    the same ones. Processes still using the old file keep it to themselves.
+    This relies on :mod:`fcntl` locks, so it's only available on POSIX systems.
+
+    :param path: the file to keep the cache in
+    :param max_entries: the number of entries the cache can hold
+    :param max_value_size: the maximum size of a value, in bytes
+    :param ways: the number of entries in each set
+    """
+
+    _MAGIC = b'SJXCACHE'
+
+    def __init__(self, path, max_entries=4096, max_value_size=16 * 1024, ways=8):
+        if fcntl is None:
+            raise RuntimeError('SharedMemoryCache is only available on POSIX systems')
+
+        #: File header (magic, format version, sets, ways, max value size)
+        self._header = struct.Struct('<8sIIII')
+        #: Slot header (key digest, expiration time, last use time, value size,
+        #: whether it's an in-flight marker, which is never evicted)
+        self._entry = struct.Struct('<16sddII')
+
+        self.path = path
+        self.ways = ways
+        self.sets = max(1, -(-max_entries // ways))
+        self.max_value_size = max_value_size
+        self._slot_size = self._entry.size + max_value_size
+        self._size = self._header.size + self.sets * ways * self._slot_size
+
+        #: The process that opened the file (it's reopened after forking)
+        self._pid = None
+        self._open_lock = threading.Lock()
+
+    def _open(self):
+        if self._pid == os.getpid():
+            return
+        with self._open_lock:
+            if self._pid == os.getpid():
+                return
+
+            if self._pid is not None:
+                # Inherited from the parent process - don't leak them
+                self._mmap.close()
+                os.close(self._fd)
+                self._pid = None
+
+            header = self._header.pack(self._MAGIC, 2, self.sets,
+                                       self.ways, self.max_value_size)
+            fd = None
+            while fd is None:
+                fd = self._open_file(header)
+            try:
+                self._mmap = mmap.mmap(fd, self._size)
+            except:
+                os.close(fd)
+                raise
+
+            self._fd = fd
+            # fcntl locks don't keep the threads of a process from each other
+            self._thread_locks = [threading.Lock() for _ in range(min(self.sets, 64))]
+            self._pid = os.getpid()
+
+    def _open_file(self, header):
+        """Opens the file, replacing it if it's new or was created
+        with other sizes.
+
+        :return: the file descriptor, or ``None`` if another process
+                 replaced the file in the meantime
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, 0)
+            if os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                os.close(fd)
+                return None
+            if (os.fstat(fd).st_size == self._size and
+                    os.pread(fd, len(header), 0) == header):
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, 0)
+                return fd
+
+            # Other processes may still have the old file mapped, so it's
+            # never truncated (they'd crash) but replaced by a new one
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            new_fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                os.ftruncate(new_fd, self._size)
+                os.pwrite(new_fd, header, 0)
+                os.replace(tmp_path, self.path)
+            except:
+                os.close(new_fd)
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+            os.close(fd)
+            return new_fd
+        except:
+            os.close(fd)
+            raise
+
+    def _locate(self, key):
+        """Returns the digest of the key and the set it belongs to."""
+        # Not marshal, whose output depends on what's interned
+        digest = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).digest()
+        return digest, int.from_bytes(digest[:8], 'little') % self.sets
+
+    def _locked(self, set_index, func, *args):
+        """Calls the function while holding the lock of the set."""
+        self._open()
+        with self._thread_locks[set_index % len(self._thread_locks)]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 1 + set_index)
+            try:
+                return func(self._header.size + set_index * self.ways * self._slot_size,
+                            *args)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 1 + set_index)
+
+    def _find(self, base, digest, now):
+        """Returns the offset of the live entry for the digest (or ``None``)
+        and the offset of the slot to store it in (``None`` if all
+        the slots hold live in-flight markers)."""
+        victim, victim_used = None, None
+        for way in range(self.ways):
+            offset = base + way * self._slot_size
+            entry_digest, expires_at, last_used, _, in_flight = \
+                self._entry.unpack_from(self._mmap, offset)
+            expired = expires_at and expires_at <= now
+            if entry_digest == digest:
+                return (None if expired else offset), offset
+            if in_flight and not expired and last_used:
+                continue
+            used = -1 if expired or not last_used else last_used
+            if victim is None or used < victim_used:
+                victim, victim_used = offset, used
+        return None, victim
+
+    def _get(self, base, digest):
+        now = time.time()
+        found, _ = self._find(base, digest, now)
+        if found is None:
+            return None
+        _, expires_at, _, length, in_flight = self._entry.unpack_from(self._mmap, found)
+        self._entry.pack_into(self._mmap, found, digest, expires_at, now, length, in_flight)
+        start = found + self._entry.size
+        return self._mmap[start:start + length]
+
+    def _store(self, base, digest, data, ttl, only_new, in_flight):
+        """Stores the data, returning ``None`` if there's no slot for it."""
+        now = time.time()
+        found, offset = self._find(base, digest, now)
+        if only_new and found is not None:
+            return False
+        if offset is None:
+            return None
+        expires_at = 0.0 if ttl is None else now + ttl
+        start = offset + self._entry.size
+        self._mmap[start:start + len(data)] = data
+        self._entry.pack_into(self._mmap, offset, digest, expires_at, now,
+                              len(data), in_flight)
+        return True
+
+    def _delete(self, base, digest):
+        found, _ = self._find(base, digest, time.time())
+        if found is not None:
+            self._entry.pack_into(self._mmap, found, b'', 0.0, 0.0, 0, 0)
+
+    def _set_value(self, key, value, ttl, only_new):
+        digest, set_index = self._locate(key)
+        data = marshal.dumps(value)
+        if len(data) > self.max_value_size:
+            # Too large to cache, but don't leave an older value behind
+            self._locked(set_index, self._delete, digest)
+            return only_new
+        stored = self._locked(set_index, self._store, digest, data, ttl,
+                              only_new, int(value == ''))
+        if stored is None:
+            # The set is full of in-flight markers
+            return only_new
+        return stored
+
+    def get(self, key):
+        """Returns the value cached for the key, or ``None``."""
+        digest, set_index = self._locate(key)
+        data = self._locked(set_index, self._get, digest)
+        if data is None:
+            return None
+        try:
+            return marshal.loads(data)
+        except (ValueError, EOFError, TypeError):
+            # Corrupted (or written by something else) - as good as missing
+            return None
+
+    def set(self, key, value, ttl=None):
+        """Caches the value for ``ttl`` seconds (or until evicted, if ``None``).
+
+        :return: ``False`` if the value is too large to cache (or its set only
+                 holds in-flight markers), ``True`` otherwise
+        """
+        return self._set_value(key, value, ttl, False)
+
+    def add(self, key, value, ttl=None):
+        """Caches the value unless the key is already set.
+
+        :return: ``False`` if the key is already set, ``True`` otherwise
+                 (even if the value couldn't be kept)
+        """
+        return self._set_value(key, value, ttl, True)
+
+    def delete(self, key):
+        digest, set_index = self._locate(key)
+        self._locked(set_index, self._delete, digest)
+
+    def clear(self):
+        """Removes all the entries (for all the processes)."""
+        def clear_set(base):
+            for way in range(self.ways):
+                self._entry.pack_into(self._mmap, base + way * self._slot_size,
+                                      b'', 0.0, 0.0, 0, 0)
+
+        for set_index in range(self.sets):
+            self._locked(set_index, clear_set)
+
+
+class _FragmentCache(object):
+    """A thread-safe cache of rendered fragments,
+    with LRU eviction and per-entry expiration."""
+
+    def __init__(self, max_entries):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the ``(html, version)`` pair cached for the key, or ``None``."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                return None
+            # Mark as recently used
+            del self._entries[key]
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl):
+        expires_at = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires_at)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _longest_increasing_subsequence(values):
+    """Returns the indexes of a longest strictly increasing
+    subsequence of the given list of numbers."""
+    tails, tail_indexes, previous = [], [], [None] * len(values)
+    for i, value in enumerate(values):
+        pos = bisect.bisect_left(tails, value)
+        if pos == len(tails):
+            tails.append(value)
+            tail_indexes.append(i)
+        else:
+            tails[pos] = value
+            tail_indexes[pos] = i
+        previous[i] = tail_indexes[pos - 1] if pos > 0 else None
+
+    result = []
+    i = tail_indexes[-1] if tail_indexes else None
+    while i is not None:
+        result.append(i)
+        i = previous[i]
+    result.reverse()
+    return result
+
+
+class KeyedList(object):
+    """Keeps a list of elements on the page in sync with the server,
+    sending only what changed since the last update.
+
+    Each item is identified by a (unique) key and rendered as a single html element
+    (its root element gets a ``data-sijax-key`` attribute in the browser).
+    On every :meth:`update`, the new list of items is compared to the one
+    sent before and the browser is told to only insert, update, remove or
+    move the elements that need it, so the amount of data sent depends on
+    how much changed and not on how long the list is.
+
+    The state of what was sent lives in this object. For Comet functions,
+    keep one around for the whole stream::
+
+        def live_table(obj_response):
+            rows = flask_sijax.KeyedList('#rows')
+            while True:
+                items = [(row.id, render_template('row.html', row=row))
+                         for row in get_rows()]
+                rows.update(obj_response, items)
+                yield obj_response
+                time.sleep(1)
+
+    To keep the state between requests, store :attr:`state` somewhere
+    (like the session) and pass it back when creating the object::
+
+        rows = flask_sijax.KeyedList('#rows', state=session.get('rows'))
+        rows.update(obj_response, items)
+        session['rows'] = rows.state
+
+    :param selector: the jQuery selector of the container element
+    :param state: the :attr:`state` of a previous object for the same
+                  container, or ``None`` if the browser's content is unknown
+                  (the first update would replace it completely then)
+    """
+
+    def __init__(self, selector, state=None):
+        self.selector = selector
+
+        #: List of ``[key, html hash]`` pairs, in the order they were sent,
+        #: or ``None`` if nothing was sent yet
+        self.state = state
+
+    @staticmethod
+    def _hash(html):
+        return hashlib.sha1(html.encode('utf-8')).hexdigest()[:16]
+
+    def diff(self, items):
+        """Computes the operations that turn what was sent before
+        into the given items and remembers the new state.
+
+        :param items: a list of ``(key, html)`` pairs, in the order they
+                      should appear in
+        :return: a list of operations for the browser
+        """
+        items = [(str(key), html) for key, html in items]
+        new_state = [[key, self._hash(html)] for key, html in items]
+        old_state, self.state = self.state, new_state
+
+        if old_state is None:
+            return [['reset', [[key, html] for key, html in items]]]
+
+        old_hashes = dict(old_state)
+        old_positions = dict((key, i) for i, (key, _) in enumerate(old_state))
+        new_keys = set(key for key, _ in items)
+
+        ops = [['remove', key] for key, _ in old_state if key not in new_keys]
+
+        # Elements that keep their relative order don't need to be moved
+        kept = [(key, html) for key, html in items if key in old_hashes]
+        stable = _longest_increasing_subsequence([old_positions[key] for key, _ in kept])
+        stable = set(kept[i][0] for i in stable)
+
+        previous_key = None
+        for (key, html), (_, html_hash) in zip(items, new_state):
+            if key not in old_hashes:
+                ops.append(['insert', key, html, previous_key])
+            else:
+                if old_hashes[key] != html_hash:
+                    ops.append(['update', key, html])
+                if key not in stable:
+                    ops.append(['move', key, previous_key])
+            previous_key = key
+        return ops
+
+    def update(self, obj_response, items):
+        """Sends the changes needed to show the given items in the browser.
+
+        :param obj_response: the response object of the Sijax function
+        :param items: a list of ``(key, html)`` pairs, in the order they
+                      should appear in
+        """
+        ops = self.diff(items)
+        if ops:
+            obj_response.call('Sijax.patchList', [self.selector, ops])
+        return obj_response
+
+
+class _CallbackPolicy(object):
+    """Flask-Sijax specific options that a callback was registered with.
+
+    These are handled by :meth:`Sijax.process_request` and are never passed
+    down to :class:`sijax.Sijax`.
+    """
+
+    #: Names of the registration options that belong to the policy
+    OPTIONS = ('max_concurrent', 'rate', 'timeout', 'validate')
+
+    def __init__(self, public_name, response_class, options,
+                 default_timeout=None, default_validate=False):
+        self.public_name = public_name
+        self.response_class = response_class
+        self.validate = options.get('validate', default_validate)
+
+        self.timeout = options.get('timeout', default_timeout)
+        if self.timeout is not None and self.timeout <= 0:
+            raise ValueError('timeout needs to be a positive number of seconds!')
+
+        self.max_concurrent = options.get('max_concurrent')
+        if self.max_concurrent is not None and self.max_concurrent < 1:
+            raise ValueError('max_concurrent needs to be a positive number!')
+
+        self.rate = options.get('rate')
+        if self.rate is not None:
+            calls, period = self.rate
+            if calls < 1 or period <= 0:
+                raise ValueError('rate needs to be a (calls, seconds) tuple!')
+
+    @property
+    def is_limited(self):
+        return self.max_concurrent is not None or self.rate is not None
+
+    def acquire(self, store, busy_retry_after):
+        """Checks the limits for a new call and takes a concurrency slot.
+
+        The concurrency limit is checked first, so that calls rejected
+        because of it don't count against the rate limit.
+
+        :return: ``None`` if the call may proceed, otherwise the number
+                 of seconds after which it makes sense to retry
+        """
+        if self.max_concurrent is not None:
+            key = 'concurrent:%s' % self.public_name
+            if not store.acquire(key, self.max_concurrent):
+                return busy_retry_after
+
+        if self.rate is not None:
+            calls, period = self.rate
+            window = int(time.time() // period)
+            key = 'rate:%s:%d' % (self.public_name, window)
+            if store.incr(key, period) > calls:
+                self.release(store)
+                return (window + 1) * period - time.time()
+
+        return None
+
+    def release(self, store):
+        if self.max_concurrent is not None:
+            store.release('concurrent:%s' % self.public_name, self.max_concurrent)
+
+    def wrap(self, callback, pool, profiler=None, args_extra=None):
+        """Returns the callback to actually register with Sijax,
+        which validates the arguments (if asked to), enforces the timeout
+        (if any), runs coroutine functions and profiles the calls
+        (if ``profiler`` is given).
+
+        ``args_extra`` are the arguments passed before the ones
+        coming from the browser, which are not validated.
+        """
+        skip = len(args_extra) if args_extra else 0
+        validator = _get_arguments_validator(callback, skip) if self.validate else None
+        if profiler is not None:
+            callback = profiler.wrap(self.public_name, callback)
+        if validator is not None:
+            callback = _with_validation(self.public_name, callback, validator, skip)
+        return _wrap_callback(self.public_name, callback, self.timeout, pool)
+
+
+class _ConcurrencySlot(object):
+    """The ``max_concurrent`` slot taken by a call.
+
+    It's released once the response is done with it, but not before
+    the threads of its abandoned (timed out) callbacks have finished too,
+    since those are still running.
+    """
+
+    def __init__(self, release):
+        self._release = release
+        self._holders = 1
+        self._lock = threading.Lock()
+
+    def hold_until_done(self, future):
+        """Keeps the slot taken until the future is done."""
+        with self._lock:
+            self._holders += 1
+        future.add_done_callback(lambda future: self.release())
+
+    def release(self):
+        with self._lock:
+            self._holders -= 1
+            if self._holders:
+                return
+        self._release()
+
+
+#: The :class:`_ConcurrencySlot` of the call being processed, if any
+_current_slot = contextvars.ContextVar('flask_sijax_slot', default=None)
+
+
+def _pop_policy_options(options):
+    """Removes the Flask-Sijax specific options from the given
+    registration options dictionary and returns them."""
+    return dict((k, options.pop(k)) for k in _CallbackPolicy.OPTIONS if k in options)
+
+
+class BufferLimitError(RuntimeError):
+    """Raised when a streaming function adds more commands between two
+    flushes than the ``SIJAX_STREAM_BUFFER_LIMIT`` config option allows."""
 
-from flask import g, request, Response, _request_ctx_stack
 
-import sijax
+class _StreamingResponseMixin(object):
+    """Improves the way streaming responses work.
+
+    :class:`sijax.response.StreamingIframeResponse` drives generators
+    by calling ``next()`` until ``StopIteration`` escapes, which Python 3.7+
+    turns into a ``RuntimeError`` (PEP 479).
+    Generators are also closed explicitly here, so that a handler
+    stops as soon as the stream is closed (the client went away),
+    instead of whenever it gets garbage collected.
+
+    To keep the memory used by each open stream predictable, commands are
+    serialized as they're added, instead of being kept as dictionaries
+    until flushed, and their total size is limited by the
+    ``SIJAX_STREAM_BUFFER_LIMIT`` config option. Handlers that are done
+    with the form data and files can let them go before the stream ends
+    (see :meth:`release_request_data`).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_StreamingResponseMixin, self).__init__(*args, **kwargs)
+
+        state = current_app.extensions.get('sijax_state') if current_app else None
+        self._buffer_limit = getattr(state, 'stream_buffer_limit', None)
+        self._buffered_bytes = 0
+
+        # The handler runs while the stream is read, after process_request()
+        self._slot = _current_slot.get()
+
+    def _add_command(self, cmd_type, params=None):
+        if params is None:
+            params = {}
+        params['type'] = cmd_type
+
+        command = self.dumps(params)
+        if self._buffer_limit is not None:
+            self._buffered_bytes += len(command.encode('utf-8'))
+            if self._buffered_bytes > self._buffer_limit:
+                raise BufferLimitError('More than %d bytes of commands buffered '
+                                       '- yield more often!' % self._buffer_limit)
+        self._commands.append(command)
+        return self
+
+    def clear_commands(self):
+        self._commands = []
+        self._buffered_bytes = 0
+        return self
+
+    def _get_json(self):
+        return '[%s]' % ','.join(self._commands)
+
+    def release_request_data(self):
+        """Drops the references to the form data and uploaded files of the
+        request, which are otherwise kept (along with the request context)
+        until the stream ends.
+
+        Call it once the handler is done with them: afterwards, ``request.form``
+        and ``request.files`` are empty. The objects the handler was passed
+        are only freed once it stops referring to them as well.
+        """
+        self._request_args = None
+        self._sijax.set_data({})
+        if has_request_context():
+            # Left empty (the body was read already, so it can't be parsed again)
+            current_request = request._get_current_object()
+            cached = current_request.__dict__
+            cached['form'] = current_request.parameter_storage_class()
+            cached['files'] = current_request.parameter_storage_class()
+            cached.pop('values', None)
+
+    def _process_callback(self, callback, args):
+        # Handlers get the files themselves, so that those
+        # are only referred to by the request from here on
+        args = [request.files if arg is _request_files else arg for arg in args]
+        token = _current_slot.set(self._slot)
+        try:
+            response = self._perform_handler_call(callback, args)
+        finally:
+            _current_slot.reset(token)
+        del args
+
+        try:
+            if isinstance(response, GeneratorType):
+                for _ in response:
+                    if len(self._commands) != 0:
+                        yield self._flush()
+            if len(self._commands) != 0:
+                yield self._flush()
+        finally:
+            if isinstance(response, GeneratorType):
+                response.close()
+
+    def _process_call_chain(self, call_chain):
+        while call_chain:
+            # Popping, so that we don't hold on to the arguments
+            # of the callbacks that were already called
+            generator = self._process_callback(*call_chain.pop(0))
+            try:
+                for string in generator:
+                    yield string.encode('utf-8')
+            finally:
+                generator.close()
+
+
+#: The ``files`` argument of upload functions, which the response
+#: replaces with ``request.files`` when calling them
+_request_files = LocalProxy(lambda: request.files)
+
+_response_classes = {}
+
+
+def _get_response_class(response_class):
+    """Returns the response class to actually use in place of
+    the given one (see :class:`_StreamingResponseMixin`)."""
+    from sijax.response import BaseResponse, StreamingIframeResponse
+
+    if response_class is None:
+        return BaseResponse
+    if (not isinstance(response_class, type) or
+            not issubclass(response_class, StreamingIframeResponse) or
+            issubclass(response_class, _StreamingResponseMixin)):
+        return response_class
+
+    fixed = _response_classes.get(response_class)
+    if fixed is None:
+        fixed = type(response_class.__name__, (_StreamingResponseMixin, response_class), {})
+        _response_classes[response_class] = fixed
+    return fixed
+
+
+def _get_args_checker(callback):
+    """Returns a function telling whether the callback could be called
+    with the given (positional) arguments.
+
+    The signature is only looked at once, here, and most signatures come down
+    to comparing the number of arguments."""
+    try:
+        signature = inspect.signature(callback)
+    except (TypeError, ValueError):
+        # Can't introspect it (some builtin) - just give it a try
+        return lambda args: True
+
+    positional = (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+    min_args, max_args = 0, 0
+    for param in signature.parameters.values():
+        if param.kind in positional:
+            max_args += 1
+            if param.default is param.empty:
+                min_args += 1
+        elif param.kind == param.VAR_POSITIONAL:
+            max_args = float('inf')
+        elif param.kind == param.KEYWORD_ONLY and param.default is param.empty:
+            # Can't be passed by Sijax - let bind() sort it out
+            break
+    else:
+        return lambda args: min_args <= len(args) <= max_args
+
+    def accepts_args(args):
+        try:
+            signature.bind(*args)
+        except TypeError:
+            return False
+        return True
+    return accepts_args
+
+
+def _in_current_context(func):
+    """Binds the function to a copy of the current context, so that
+    it still sees the current request (and `g`) when called
+    from another thread."""
+    context = contextvars.copy_context()
+    return lambda *args: context.run(func, *args)
+
+
+def _wrap_callback(public_name, callback, timeout, pool):
+    """Wraps the callback, so that it can't run for longer than ``timeout``
+    seconds and so that coroutine functions are run to completion.
+
+    - coroutine functions are cancelled when the timeout expires
+    - generator functions are checked between the yields
+    - regular functions run in the ``pool`` (a :class:`_TimeoutPool`) and are
+      abandoned when the timeout expires (threads can't be killed, but
+      the request is no longer stuck waiting for them)
+    """
+    is_coroutine = inspect.iscoroutinefunction(callback)
+    if timeout is None and not is_coroutine:
+        return callback
+
+    accepts_args = _get_args_checker(callback)
+
+    def on_timeout(obj_response):
+        event_timeout = Sijax.EVENT_TIMEOUT
+        return obj_response._sijax.get_event(event_timeout)(obj_response, public_name, timeout)
+
+    def on_busy(obj_response):
+        event_busy = Sijax.EVENT_BUSY
+        return obj_response._sijax.get_event(event_busy)(obj_response, public_name,
+                                                         pool.busy_retry_after)
+
+    def on_invalid_call(obj_response):
+        return _invalid_call_handler(obj_response, callback)
+
+    if is_coroutine:
+        def wrapper(obj_response, *args):
+            if not accepts_args((obj_response,) + args):
+                return on_invalid_call(obj_response)
+            try:
+                return asyncio.run(asyncio.wait_for(callback(obj_response, *args), timeout))
+            except asyncio.TimeoutError:
+                # wait_for() has already cancelled the handler
+                return on_timeout(obj_response)
+    elif inspect.isgeneratorfunction(callback):
+        def wrapper(obj_response, *args):
+            if not accepts_args((obj_response,) + args):
+                return on_invalid_call(obj_response)
+            return _generator_with_deadline(callback(obj_response, *args), obj_response,
+                                            time.time() + timeout,
+                                            lambda: on_timeout(obj_response))
+    else:
+        def wrapper(obj_response, *args):
+            if not accepts_args((obj_response,) + args):
+                return on_invalid_call(obj_response)
+
+            # An abandoned call may keep adding commands, so it gets
+            # a response object of its own, whose commands are only
+            # taken if it finishes in time
+            own_response = _copy_response(obj_response)
+            outcome = pool.run(_in_current_context(callback),
+                               (own_response,) + args, timeout)
+            if outcome is None:
+                return on_busy(obj_response)
+            finished, result = outcome
+            if not finished:
+                slot = _current_slot.get()
+                if slot is not None:
+                    # Still running, so it still counts against max_concurrent
+                    slot.hold_until_done(result)
+                return on_timeout(obj_response)
+
+            obj_response._commands.extend(own_response._commands)
+            if isinstance(obj_response, _StreamingResponseMixin):
+                obj_response._buffered_bytes += own_response._buffered_bytes
+            return obj_response if result is own_response else result
+
+    return wrapper
+
+
+def _copy_response(obj_response):
+    """Returns a copy of the response object, without any commands."""
+    response = copy.copy(obj_response)
+    response.clear_commands()
+    return response
+
+
+class _TimeoutPool(object):
+    """The threads that run the regular callbacks which have a timeout.
+
+    An abandoned callback keeps its thread until it returns. Rather than
+    waiting for a thread (and timing out without having run), calls finding
+    all of them taken are rejected as busy.
+    """
+
+    def __init__(self, max_workers, busy_retry_after):
+        #: Seconds after which a call rejected as busy should be retried
+        self.busy_retry_after = busy_retry_after
+
+        self._max_workers = max_workers
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(self._max_workers)
+            return self._executor
+
+    def run(self, func, args, timeout):
+        """Calls ``func(*args)`` in one of the threads, waiting for it
+        up to ``timeout`` seconds from when it starts running.
+
+        :return: ``None`` if all the threads are taken, otherwise
+                 a ``(finished, result)`` pair (the result being the future
+                 of the abandoned call if it didn't finish)
+        """
+        if not self._slots.acquire(False):
+            return None
+
+        started = threading.Event()
+
+        def run():
+            started.set()
+            try:
+                return func(*args)
+            finally:
+                self._slots.release()
+
+        try:
+            future = self._get_executor().submit(run)
+        except:
+            self._slots.release()
+            raise
+
+        # A thread is free, so this shouldn't take long
+        if not started.wait(timeout) and future.cancel():
+            self._slots.release()
+            return None
+
+        try:
+            return True, future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            return False, future
+
+
+def _invalid_call_handler(obj_response, callback):
+    """Runs the Sijax "invalid call" event handler.
+
+    Wrappers need to check the arguments themselves, because Sijax
+    can't tell a bad call from a ``TypeError`` raised by the wrapper."""
+    event_invalid_call = obj_response._sijax.__class__.EVENT_INVALID_CALL
+    return obj_response._sijax.get_event(event_invalid_call)(obj_response, callback)
+
+
+def _generator_with_deadline(generator, obj_response, deadline, on_timeout):
+    """Re-yields what the handler generator yields, stopping it
+    if it's still running after the deadline.
+
+    The commands added during the step that overran the deadline
+    are dropped, so that only the timeout gets sent for it."""
+    try:
+        while True:
+            step_start = len(obj_response._commands)
+            try:
+                item = next(generator)
+                finished = False
+            except StopIteration:
+                finished = True
+            if time.time() > deadline:
+                generator.close()
+                dropped = obj_response._commands[step_start:]
+                del obj_response._commands[step_start:]
+                if isinstance(obj_response, _StreamingResponseMixin):
+                    obj_response._buffered_bytes -= sum(len(command.encode('utf-8'))
+                                                        for command in dropped)
+                on_timeout()
+                return
+            if finished:
+                return
+            yield item
+    finally:
+        generator.close()
+
+
+def _describe_type(hint):
+    return getattr(hint, '__name__', None) or str(hint).replace('typing.', '')
+
+
+def _json_type_name(value):
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, (int, float)):
+        return 'number'
+    if isinstance(value, str):
+        return 'string'
+    if isinstance(value, list):
+        return 'array'
+    if isinstance(value, dict):
+        return 'object'
+    return type(value).__name__
+
+
+def _to_int(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(value.strip())
+        except ValueError:
+            raise ValueError('expected an integer, got "%s"' % value)
+    raise ValueError('expected an integer, got %s' % _json_type_name(value))
+
+
+def _to_float(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.strip())
+        except ValueError:
+            raise ValueError('expected a number, got "%s"' % value)
+    raise ValueError('expected a number, got %s' % _json_type_name(value))
+
+
+def _to_str(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    raise ValueError('expected a string, got %s' % _json_type_name(value))
+
+
+#: String values accepted for `bool` arguments (form values, mostly)
+_BOOL_STRINGS = {'true': True, '1': True, 'on': True, 'yes': True,
+                 'false': False, '0': False, 'off': False, 'no': False, '': False}
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.lower() in _BOOL_STRINGS:
+        return _BOOL_STRINGS[value.lower()]
+    raise ValueError('expected a boolean, got %s' % _json_type_name(value))
+
+
+_SCALAR_CONVERTERS = {int: _to_int, float: _to_float, str: _to_str, bool: _to_bool}
+
+#: The classes of the values JSON decodes to
+_JSON_TYPES = (type(None), bool, int, float, str, list, dict)
+
+
+def _compile_converter(hint):
+    """Returns a function converting a (JSON) value to the type
+    described by the type hint, raising ``ValueError`` if it can't.
+
+    ``None`` is returned for hints that accept anything.
+    """
+    if hint is inspect.Parameter.empty or hint is typing.Any or hint is object:
+        return None
+    if hint is None or hint is type(None):
+        def convert(value):
+            if value is not None:
+                raise ValueError('expected null, got %s' % _json_type_name(value))
+            return value
+        return convert
+    if hint in _SCALAR_CONVERTERS:
+        return _SCALAR_CONVERTERS[hint]
+
+    origin = typing.get_origin(hint)
+    hint_args = typing.get_args(hint)
+
+    if origin is typing.Union or (origin is not None and origin is getattr(types, 'UnionType', ())):
+        nullable = type(None) in hint_args
+        converters = [_compile_converter(h) for h in hint_args if h is not type(None)]
+        if None in converters:
+            return None
+        description = ' or '.join(_describe_type(h) for h in hint_args)
+
+        def convert(value):
+            if value is None and nullable:
+                return value
+            for converter in converters:
+                try:
+                    return converter(value)
+                except ValueError:
+                    pass
+            raise ValueError('expected %s, got %s' % (description, _json_type_name(value)))
+        return convert
+
+    if hint is list or origin is list:
+        item_converter = _compile_converter(hint_args[0]) if hint_args else None
+
+        def convert(value):
+            if not isinstance(value, list):
+                raise ValueError('expected an array, got %s' % _json_type_name(value))
+            if item_converter is None:
+                return value
+            result = []
+            for index, item in enumerate(value):
+                try:
+                    result.append(item_converter(item))
+                except ValueError as e:
+                    raise ValueError('item %d: %s' % (index, e))
+            return result
+        return convert
+
+    if hint is tuple or origin is tuple:
+        if hint_args and not (len(hint_args) == 2 and hint_args[1] is Ellipsis):
+            item_converters = [_compile_converter(h) for h in hint_args]
+        else:
+            # Any length (``Tuple[int, ...]`` or just ``tuple``)
+            item_converter = _compile_converter(hint_args[0]) if hint_args else None
+            item_converters = None
+
+        def convert(value):
+            if not isinstance(value, list):
+                raise ValueError('expected an array, got %s' % _json_type_name(value))
+            converters = item_converters
+            if converters is None:
+                converters = [item_converter] * len(value)
+            elif len(value) != len(converters):
+                raise ValueError('expected an array of %d items, got %d'
+                                 % (len(converters), len(value)))
+            result = []
+            for index, (converter, item) in enumerate(zip(converters, value)):
+                try:
+                    result.append(item if converter is None else converter(item))
+                except ValueError as e:
+                    raise ValueError('item %d: %s' % (index, e))
+            return tuple(result)
+        return convert
+
+    if hint is dict or origin is dict:
+        value_converter = _compile_converter(hint_args[1]) if hint_args else None
+
+        def convert(value):
+            if not isinstance(value, dict):
+                raise ValueError('expected an object, got %s' % _json_type_name(value))
+            if value_converter is None:
+                return value
+            result = {}
+            for key, item in value.items():
+                try:
+                    result[key] = value_converter(item)
+                except ValueError as e:
+                    raise ValueError('key "%s": %s' % (key, e))
+            return result
+        return convert
+
+    expected = origin or hint
+    if (not isinstance(expected, type) or
+            not any(issubclass(t, expected) for t in _JSON_TYPES)):
+        # Nothing coming from the browser could ever match it
+        raise TypeError('Unsupported type hint for Sijax argument validation: %r' % (hint,))
+
+    def convert(value):
+        if not isinstance(value, expected):
+            raise ValueError('expected %s, got %s' % (_describe_type(expected),
+                                                      _json_type_name(value)))
+        return value
+    return convert
+
+
+def _get_type_hints(callback):
+    """Returns the type hints of the callback's parameters.
+
+    Partials and callable objects are looked into, since
+    :func:`typing.get_type_hints` doesn't support them. Hints that
+    can't be resolved are left out (the annotations are used as they are).
+    """
+    target = callback
+    while isinstance(target, functools.partial):
+        target = target.func
+    if not (inspect.isfunction(target) or inspect.ismethod(target)):
+        target = getattr(type(target), '__call__', target)
+    try:
+        return typing.get_type_hints(target)
+    except Exception:
+        return {}
+
+
+class _ArgumentsValidator(object):
+    """Checks and converts the arguments coming from the browser,
+    according to the signature and type hints of a callback function.
+
+    Everything is worked out once, when creating the validator.
+    """
+
+    def __init__(self, callback, skip):
+        signature = inspect.signature(callback)
+        hints = _get_type_hints(callback)
+
+        self._params = []
+        self._varargs = None
+        self._min_count = 0
+
+        # The first parameter is the response object, followed by `args_extra`
+        positional = (inspect.Parameter.POSITIONAL_ONLY,
+                      inspect.Parameter.POSITIONAL_OR_KEYWORD)
+        params = list(signature.parameters.values())[1 + skip:]
+        for param in params:
+            hint = hints.get(param.name, param.annotation)
+            if isinstance(hint, str):
+                # A forward reference that couldn't be resolved - don't convert
+                hint = inspect.Parameter.empty
+            converter = _compile_converter(hint)
+            if param.kind in positional:
+                self._params.append((param.name, converter))
+                if param.default is inspect.Parameter.empty:
+                    self._min_count = len(self._params)
+            elif param.kind == inspect.Parameter.VAR_POSITIONAL:
+                self._varargs = (param.name, converter)
+            elif param.kind == inspect.Parameter.KEYWORD_ONLY \
+                    and param.default is inspect.Parameter.empty:
+                raise TypeError('%s can\'t be called by Sijax, since it has '
+                                'required keyword-only arguments!' % callback)
+
+        self._max_count = None if self._varargs is not None else len(self._params)
+        self._has_converters = any(c is not None for _, c in self._params) \
+            or (self._varargs is not None and self._varargs[1] is not None)
+
+    def _describe_count(self):
+        if self._max_count is None:
+            return 'at least %d' % self._min_count
+        if self._min_count == self._max_count:
+            return '%d' % self._min_count
+        return '%d to %d' % (self._min_count, self._max_count)
+
+    def __call__(self, args):
+        """Returns the converted arguments and a list of errors
+        (dictionaries with the ``argument`` name, its ``index``
+        and a ``message``), which is empty if all is well."""
+        count = len(args)
+        if count < self._min_count or (self._max_count is not None and count > self._max_count):
+            message = 'expected %s arguments, got %d' % (self._describe_count(), count)
+            return args, [{'argument': None, 'index': None, 'message': message}]
+        if not self._has_converters:
+            return args, []
+
+        result = list(args)
+        errors = []
+        params_count = len(self._params)
+        for index, value in enumerate(args):
+            name, converter = self._params[index] if index < params_count else self._varargs
+            if converter is None:
+                continue
+            try:
+                result[index] = converter(value)
+            except ValueError as e:
+                errors.append({'argument': name, 'index': index, 'message': str(e)})
+        return result, errors
+
+
+#: Validators for the functions registered with ``validate=True``
+#: (function => {(skip, is bound method) => _ArgumentsValidator})
+_validators_cache = weakref.WeakKeyDictionary()
+
+
+def _get_arguments_validator(callback, skip):
+    """Returns the (cached) :class:`_ArgumentsValidator` for the callback,
+    or ``None`` if its signature can't be looked at.
+
+    Callbacks are usually registered on every request, so the validator
+    is kept for as long as the function (not the bound method) is around.
+    """
+    try:
+        inspect.signature(callback)
+    except (TypeError, ValueError):
+        # Can't introspect it (some builtin) - leave the checks to Sijax
+        return None
+
+    function = getattr(callback, '__func__', callback)
+    key = (skip, function is not callback)
+    try:
+        validators = _validators_cache.setdefault(function, {})
+    except TypeError:
+        # Can't be weakly referenced (a callable object, or a partial)
+        return _ArgumentsValidator(callback, skip)
+    validator = validators.get(key)
+    if validator is None:
+        validator = validators[key] = _ArgumentsValidator(callback, skip)
+    return validator
+
+
+def _with_validation(public_name, callback, validator, skip):
+    """Wraps the callback (keeping it a regular, generator or coroutine
+    function), so that it's only called with valid (converted) arguments.
+
+    Otherwise, the :attr:`Sijax.EVENT_INVALID_ARGS` event handler is called.
+    """
+    def check(obj_response, args):
+        valid_args, errors = validator(args[skip:])
+        if errors:
+            handler = obj_response._sijax.get_event(Sijax.EVENT_INVALID_ARGS)
+            return None, lambda: handler(obj_response, public_name, errors)
+        return args[:skip] + tuple(valid_args), None
+
+    if inspect.iscoroutinefunction(callback):
+        @wraps(callback)
+        async def wrapper(obj_response, *args):
+            args, reject = check(obj_response, args)
+            if reject is not None:
+                return reject()
+            return await callback(obj_response, *args)
+    elif inspect.isgeneratorfunction(callback):
+        @wraps(callback)
+        def wrapper(obj_response, *args):
+            args, reject = check(obj_response, args)
+            if reject is not None:
+                reject()
+                return
+            yield from callback(obj_response, *args)
+    else:
+        @wraps(callback)
+        def wrapper(obj_response, *args):
+            args, reject = check(obj_response, args)
+            if reject is not None:
+                return reject()
+            return callback(obj_response, *args)
+
+    # Any arguments are accepted - the checks done by other wrappers
+    # must not get ahead of the validator's (more detailed) ones
+    del wrapper.__wrapped__
+    return wrapper
+
+
+def _invalid_args_handler(obj_response, func_name, errors):
+    """Default handler for :attr:`Sijax.EVENT_INVALID_ARGS`.
+
+    Passes the errors to ``Sijax.invalidArgs`` in the browser.
+    """
+    obj_response.call('Sijax.invalidArgs', [func_name, errors])
+
+
+def _timeout_handler(obj_response, func_name, timeout):
+    """Default handler for :attr:`Sijax.EVENT_TIMEOUT`."""
+    msg = 'The action you performed took too long to complete! (Sijax error)'
+    obj_response.alert(msg)
+
+
+def _busy_handler(obj_response, func_name, retry_after):
+    """Default handler for :attr:`Sijax.EVENT_BUSY`.
+
+    Tells the browser to retry the call later (with backoff).
+    """
+    from sijax.plugin.comet import CometResponse
+    from sijax.plugin.upload import UploadResponse
+
+    if isinstance(obj_response, UploadResponse):
+        mode = 'upload'
+    elif isinstance(obj_response, CometResponse):
+        mode = 'comet'
+    else:
+        mode = 'request'
+
+    request_args = obj_response._sijax.request_args
+    delay = int(retry_after * 1000)
+    params = [func_name, request_args, delay, mode]
+    key = obj_response._sijax.get_data().get(PARAM_IDEMPOTENCY_KEY)
+    if key and mode == 'request':
+        # Retrying with the same key, in case the call is still running
+        params.append(key)
+    obj_response.call('Sijax.busy', params)
+
+
+def _get_request_uri(environ):
+    """Returns the relative URI (path and query string) of the request.
+
+    It's what ``request.url`` would give without the scheme and host,
+    but made straight from the WSGI environ, without building (and checking)
+    the full URL, which is otherwise unused.
+    """
+    return _quote_request_uri(environ.get('SCRIPT_NAME', ''),
+                              environ.get('PATH_INFO', ''),
+                              environ.get('QUERY_STRING', ''))
+
+
+#: Characters that Werkzeug leaves unquoted in the path/query string of `request.url`
+_URI_PATH_SAFE = "!$&'()*+,/:;=@%"
+_URI_QUERY_SAFE = "!$&'()*+,/:;=?@%"
+
+_uri_path_unsafe_re = re.compile(r"[^A-Za-z0-9_.~\-%s]" % re.escape(_URI_PATH_SAFE))
+_uri_query_unsafe_re = re.compile(r"[^A-Za-z0-9_.~\-%s]" % re.escape(_URI_QUERY_SAFE))
+
+
+@lru_cache(maxsize=256)
+def _quote_request_uri(script_name, path_info, query_string):
+    # WSGI environ strings hold the raw bytes, decoded as latin-1.
+    # Quoting is done like Werkzeug does for `request.url`,
+    # but non-ASCII characters are kept quoted.
+    # Most URIs need no quoting at all, which is much cheaper to check for.
+    uri = '%s/%s' % (script_name.rstrip('/'), path_info.lstrip('/'))
+    if _uri_path_unsafe_re.search(uri) is not None:
+        uri = quote(uri.encode('latin-1'), safe=_URI_PATH_SAFE)
+    if query_string:
+        if _uri_query_unsafe_re.search(query_string) is not None:
+            query_string = quote(query_string.encode('latin-1'), safe=_URI_QUERY_SAFE)
+        uri += '?' + query_string
+    return uri
+
+
+class _Profiler(object):
+    """Profiles sampled callback calls with :mod:`cProfile`, keeping
+    the stats of the last few calls to each function
+    (see the ``SIJAX_PROFILING`` config option).
+
+    Only the time spent in the handler itself is profiled - not the rest
+    of the request and, for streaming functions, not the time spent
+    sending the output between the yields.
+    """
+
+    def __init__(self, sample_rate, header, token, max_entries):
+        self.sample_rate = sample_rate
+        self.header = header
+        self.token = token
+        self._max_entries = max_entries
+        self._entries = {}
+        self._last_id = 0
+        self._lock = threading.Lock()
+
+    def is_authorized(self, token):
+        if self.token is None or token is None:
+            return False
+        return hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8'))
+
+    def should_profile(self, request):
+        """Decides whether the calls made by the current request get profiled.
+
+        That's the case for requests carrying the profiling token
+        in the :attr:`header`, and for a ``sample_rate`` fraction of the rest.
+        """
+        if self.header is not None and self.is_authorized(request.headers.get(self.header)):
+            return True
+        if self.sample_rate <= 0:
+            return False
+        return random.random() < self.sample_rate
+
+    def add(self, public_name, profile, duration):
+        """Stores the stats collected by the ``profile``."""
+        try:
+            data = marshal.dumps(pstats.Stats(profile).stats)
+        except TypeError:
+            # Nothing was collected
+            return
+
+        with self._lock:
+            self._last_id += 1
+            entries = self._entries.get(public_name)
+            if entries is None:
+                entries = self._entries[public_name] = deque(maxlen=self._max_entries)
+            entries.append({'id': self._last_id, 'name': public_name,
+                            'time': time.time(), 'duration': duration,
+                            'data': data})
+
+    def get_entries(self, public_name=None):
+        """Returns the stored entries (newest first), optionally only
+        the ones for the given function.
+
+        The ``data`` of each entry can be loaded with :class:`pstats.Stats`
+        once written to a file."""
+        with self._lock:
+            if public_name is None:
+                entries = [e for name in self._entries for e in self._entries[name]]
+            else:
+                entries = list(self._entries.get(public_name, ()))
+        return sorted(entries, key=lambda e: e['id'], reverse=True)
+
+    def get_entry(self, entry_id):
+        for entry in self.get_entries():
+            if entry['id'] == entry_id:
+                return entry
+        return None
+
+    def _start(self):
+        """Returns a running profile if the current call is to be profiled."""
+        if not g.get('_sijax_profile', False):
+            return None
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            return None
+        return profile
+
+    def wrap(self, public_name, callback):
+        """Returns a callback of the same kind (regular, generator or
+        coroutine function), which profiles the calls when it should."""
+        accepts_args = _get_args_checker(callback)
+
+        def check_args(obj_response, args):
+            return accepts_args((obj_response,) + args)
+
+        if inspect.iscoroutinefunction(callback):
+            @wraps(callback)
+            async def wrapper(obj_response, *args):
+                if not check_args(obj_response, args):
+                    return _invalid_call_handler(obj_response, callback)
+                profile = self._start()
+                if profile is None:
+                    return await callback(obj_response, *args)
+                started = time.time()
+                try:
+                    return await callback(obj_response, *args)
+                finally:
+                    profile.disable()
+                    self.add(public_name, profile, time.time() - started)
+        elif inspect.isgeneratorfunction(callback):
+            @wraps(callback)
+            def wrapper(obj_response, *args):
+                if not check_args(obj_response, args):
+                    _invalid_call_handler(obj_response, callback)
+                    return
+                profile = self._start()
+                if profile is None:
+                    yield from callback(obj_response, *args)
+                    return
+                started = time.time()
+                generator = None
+                try:
+                    generator = callback(obj_response, *args)
+                    while True:
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            return
+                        finally:
+                            profile.disable()
+                        yield item
+                        profile.enable()
+                finally:
+                    profile.disable()
+                    if generator is not None:
+                        generator.close()
+                    self.add(public_name, profile, time.time() - started)
+        else:
+            @wraps(callback)
+            def wrapper(obj_response, *args):
+                if not check_args(obj_response, args):
+                    return _invalid_call_handler(obj_response, callback)
+                profile = self._start()
+                if profile is None:
+                    return callback(obj_response, *args)
+                started = time.time()
+                try:
+                    return callback(obj_response, *args)
+                finally:
+                    profile.disable()
+                    self.add(public_name, profile, time.time() - started)
+
+        return wrapper
+
+
+class _SijaxState(object):
+    """The Flask-Sijax configuration and resources of an application,
+    kept as ``app.extensions['sijax_state']``
+    (``app.extensions['sijax']`` is the :class:`Sijax` object).
+
+    Nothing in here changes while handling requests, except for
+    the caches and the lazily created resources, so applications
+    don't get in each other's way, even when they share a :class:`Sijax` object.
+    """
+
+    def __init__(self, sijax, config):
+        #: The :class:`Sijax` object the application was initialized with
+        self.sijax = sijax
+
+        #: The URI to json2.js (JSON support for browsers without native one)
+        self.json_uri = config.get('SIJAX_JSON_URI', None)
+
+        #: Whether the javascript files are served from memory
+        #: (see :func:`sijax_asset_url`)
+        self.serve_assets = config.get('SIJAX_SERVE_ASSETS', False)
+
+        #: The :class:`LimitStore` used to enforce callback limits
+        self.limit_store = config.get('SIJAX_LIMIT_STORE', None)
+        if self.limit_store is None:
+            self.limit_store = LocalLimitStore()
+
+        #: Seconds after which a call rejected by ``max_concurrent``
+        #: should be retried
+        self.busy_retry_after = config.get('SIJAX_BUSY_RETRY_AFTER', 0.5)
+
+        #: The timeout for callbacks registered without an explicit one
+        self.callback_timeout = config.get('SIJAX_CALLBACK_TIMEOUT', None)
+
+        #: The maximum number of threads running callbacks with a timeout
+        self.timeout_workers = config.get('SIJAX_TIMEOUT_WORKERS', 16)
+
+        #: Whether callbacks registered without an explicit
+        #: ``validate`` option get their arguments validated
+        self.validate_args = config.get('SIJAX_VALIDATE_ARGS', False)
+
+        #: The maximum size of the commands streaming functions
+        #: may add between two flushes
+        self.stream_buffer_limit = config.get('SIJAX_STREAM_BUFFER_LIMIT', 1024 * 1024)
+
+        #: Cache of the fragments rendered by :meth:`Sijax.render_fragment`
+        self.fragment_cache = config.get('SIJAX_FRAGMENT_CACHE', None)
+        if self.fragment_cache is None:
+            self.fragment_cache = _FragmentCache(config.get('SIJAX_FRAGMENT_CACHE_SIZE', 256))
+
+        #: How long fragments are cached for, unless specified
+        self.fragment_ttl = config.get('SIJAX_FRAGMENT_CACHE_TTL', 300)
+
+        #: How long the responses of calls with an idempotency key are kept
+        #: for, so that retries get them again (``None`` disables that)
+        self.idempotency_ttl = config.get('SIJAX_IDEMPOTENCY_TTL', None)
+
+        #: How long a retried call waits for the original one to finish
+        self.idempotency_wait = config.get('SIJAX_IDEMPOTENCY_WAIT', 30)
+
+        #: Returns what identifies the user making the call, so that
+        #: the same idempotency key sent by someone else doesn't get
+        #: the response of their call
+        self.idempotency_scope = config.get('SIJAX_IDEMPOTENCY_SCOPE',
+                                            _get_idempotency_scope)
+
+        #: The :class:`IdempotencyStore` keeping the responses
+        self.idempotency_store = config.get('SIJAX_IDEMPOTENCY_STORE', None)
+        if self.idempotency_store is None and self.idempotency_ttl:
+            self.idempotency_store = LocalIdempotencyStore()
+
+        #: The :class:`_Profiler` for callback calls, when profiling is enabled
+        self.profiler = None
+        if config.get('SIJAX_PROFILING', False):
+            self.profiler = _Profiler(config.get('SIJAX_PROFILING_SAMPLE_RATE', 0),
+                                      config.get('SIJAX_PROFILING_HEADER', 'X-Sijax-Profile'),
+                                      config.get('SIJAX_PROFILING_TOKEN', None),
+                                      config.get('SIJAX_PROFILING_KEEP', 10))
+
+        #: The threads running regular callbacks with a timeout
+        #: (started when first needed)
+        self.timeout_pool = _TimeoutPool(self.timeout_workers, self.busy_retry_after)
+
+        #: The functions of each :class:`SijaxRegistry`, registered
+        #: for this application (:class:`SijaxRegistry` => :class:`_Registry`)
+        self._blueprint_registries = {}
+
+        #: The registries that apply to each endpoint (endpoint => list)
+        self._endpoint_registries = {}
+        self._registries_lock = threading.Lock()
+
+    def get_registry(self, sijax_registry):
+        """Returns the functions of the :class:`SijaxRegistry`,
+        registering them (with this application's configuration)
+        the first time, and those added to it since then later on."""
+        registry = self._blueprint_registries.get(sijax_registry)
+        if registry is None or sijax_registry._is_newer(registry):
+            with self._registries_lock:
+                registry = self._blueprint_registries.get(sijax_registry)
+                if registry is None:
+                    registry = sijax_registry._build(self)
+                    self._blueprint_registries[sijax_registry] = registry
+                else:
+                    sijax_registry._update(registry)
+        return registry
+
+    def get_blueprint_registries(self, endpoint, blueprint_names):
+        """Returns the registries of the blueprints (innermost first)
+        that the endpoint belongs to."""
+        registries = self._endpoint_registries.get(endpoint)
+        if registries is not None:
+            for registry in registries:
+                if registry.source._is_newer(registry):
+                    self.get_registry(registry.source)
+        else:
+            registries = []
+            for name in blueprint_names:
+                blueprint = current_app.blueprints.get(name)
+                sijax_registry = _blueprint_registries.get(blueprint) \
+                    if blueprint is not None else None
+                if sijax_registry is not None:
+                    registries.append(self.get_registry(sijax_registry))
+            self._endpoint_registries[endpoint] = registries
+        return registries
+
+
+def _get_endpoint_blueprint_names(endpoint):
+    """Returns the names of the blueprints (innermost first)
+    the endpoint belongs to, the same way Flask works them out for requests."""
+    names = []
+    name = endpoint.rpartition('.')[0]
+    while name:
+        names.append(name)
+        name = name.rpartition('.')[0]
+    return names
+
+
+def _get_client_uris(state, blueprint_registries):
+    """Returns the ``(request URI, json2.js URI)`` pair that the pages
+    of an endpoint are configured with (either may be ``None``).
+
+    A ``None`` request URI means that the URI of the page itself is used.
+    """
+    request_uri, json_uri = None, state.json_uri
+    for blueprint_registry in blueprint_registries:
+        request_uri = request_uri or blueprint_registry.request_uri
+        json_uri = blueprint_registry.json_uri or json_uri
+
+    if json_uri is None and state.serve_assets:
+        json_uri = sijax_asset_url('json2.js')
+    return request_uri, json_uri
+
+
+class _Registry(object):
+    """Functions registered with a :class:`sijax.Sijax` object,
+    along with their Flask-Sijax specific policies.
+
+    There's one for each request (see :meth:`Sijax.register_callback`)
+    and one for each :class:`SijaxRegistry` in each application, created
+    ahead of the requests (``deferred``).
+    """
+
+    def __init__(self, state, sijax_instance, deferred=False):
+        self.state = state
+        self.sijax = sijax_instance
+        self.deferred = deferred
+
+        #: public name => :class:`_CallbackPolicy`
+        self.policies = {}
+
+        #: What each function was registered with (public name => (callback, options)),
+        #: so that it could be registered again, with another :class:`sijax.Sijax` object
+        self.entries = {}
+
+        #: The registries (of blueprints) to look for functions
+        #: that were not registered with this one
+        self.fallbacks = ()
+
+        #: The request and json2.js URIs to use instead of the default ones
+        #: (for registries of blueprints)
+        self.request_uri = None
+        self.json_uri = None
+
+        #: The :class:`SijaxRegistry` this was built from (if any) and the number
+        #: of its registrations applied so far
+        self.source = None
+        self.applied = 0
+
+    def register(self, public_name, callback, options, register):
+        """Registers a callback using the given ``register`` function,
+        after taking care of the Flask-Sijax specific options."""
+        state = self.state
+        policy_options = _pop_policy_options(options)
+        response_class = _get_response_class(options.get('response_class'))
+        options['response_class'] = response_class
+
+        policy = _CallbackPolicy(public_name, response_class, policy_options,
+                                 state.callback_timeout, state.validate_args)
+        callback = policy.wrap(callback, state.timeout_pool, state.profiler,
+                               options.get('args_extra'))
+        result = register(callback, **options)
+        self.policies[public_name] = policy
+        self.entries[public_name] = (callback, options)
+        return result
+
+    def resolve(self, public_name):
+        """Returns the policy of the function, registering it from
+        the fallback registries if it's found there only."""
+        policy = self.policies.get(public_name)
+        if policy is not None or public_name is None:
+            return policy
+        for registry in self.fallbacks:
+            if public_name in registry.entries:
+                callback, options = registry.entries[public_name]
+                self.sijax.register_callback(public_name, callback, **options)
+                policy = self.policies[public_name] = registry.policies[public_name]
+                return policy
+        return None
+
+    def register_callback(self, public_name, callback, response_class=None,
+                          args_extra=None, **kwargs):
+        kwargs['response_class'] = response_class
+        kwargs['args_extra'] = args_extra
+        register = lambda callback, **options: \
+            self.sijax.register_callback(public_name, callback, **options)
+        self.register(public_name, callback, kwargs, register)
+
+    def register_object(self, obj, **kwargs):
+        for public_name, callback in _get_public_callables(obj):
+            self.register_callback(public_name, callback, **kwargs)
+
+    def register_comet_callback(self, public_name, callback, **kwargs):
+        if kwargs.get('response_class') is None:
+            from sijax.plugin.comet import CometResponse
+            kwargs['response_class'] = CometResponse
+        self.register_callback(public_name, callback, **kwargs)
+
+    def register_comet_object(self, obj, **kwargs):
+        for public_name, callback in _get_public_callables(obj):
+            self.register_comet_callback(public_name, callback, **kwargs)
+
+    def register_upload_callback(self, form_id, callback, **kwargs):
+        from sijax.plugin import upload
+
+        if 'args_extra' not in kwargs:
+            # Resolved to the files of the request being handled
+            kwargs['args_extra'] = [_request_files]
+        if kwargs.get('response_class') is None:
+            kwargs['response_class'] = upload.UploadResponse
+        register = lambda callback, **options: \
+            upload.register_upload_callback(self.sijax, form_id, callback, **options)
+        return self.register(upload.func_name_by_form_id(form_id), callback, kwargs, register)
+
 
 class Sijax(object):
     """Helper class that you'll use to interact with Sijax.
@@ -15,15 +2030,32 @@ class Sijax(object):
     although the API differs slightly in order to make things easier for you.
     """
 
-    def __init__(self, app=None):
-        self._request_uri = None
-
-        #: Reference to the underlying :class:`sijax.Sijax` object
-        self._sijax = None
-
-        #: The URI to json2.js (JSON support for browsers without native one)
-        self._json_uri = None
+    #: Event called instead of the requested function, when calling it
+    #: would exceed the limits it was registered with
+    #: (see :meth:`register_callback`).
+    #: The event handler function receives the Response object argument,
+    #: followed by the public name of the function that was requested
+    #: and the number of seconds after which the call could be retried.
+    EVENT_BUSY = 'busy'
+
+    #: Event called when the requested function didn't complete within
+    #: its timeout (see :meth:`register_callback`).
+    #: The event handler function receives the Response object argument,
+    #: followed by the public name of the function that was requested
+    #: and the timeout (in seconds) that it exceeded.
+    EVENT_TIMEOUT = 'timeout'
+
+    #: Event called instead of the requested function, when the arguments
+    #: it was called with don't match its signature and type hints
+    #: (for functions registered with ``validate=True``,
+    #: see :meth:`register_callback`).
+    #: The event handler function receives the Response object argument,
+    #: followed by the public name of the function that was requested
+    #: and a list of errors (dictionaries with the ``argument`` name,
+    #: its ``index`` and a ``message``).
+    EVENT_INVALID_ARGS = 'invalid_args'
 
+    def __init__(self, app=None):
         if app is not None:
             self.init_app(app)
 
@@ -31,25 +2063,82 @@ class Sijax(object):
         app.before_request(self._on_before_request)
 
         static_path = app.config.get('SIJAX_STATIC_PATH', None)
-        if static_path is not None:
-            sijax.helper.init_static_path(static_path)
+        if static_path is not None and app.config.get('SIJAX_STATIC_DEPLOY', True):
+            deploy_static_files(static_path)
+
+        state = _SijaxState(self, app.config)
 
-        self._json_uri = app.config.get('SIJAX_JSON_URI', None)
+        if state.serve_assets:
+            url_prefix = app.config.get('SIJAX_ASSETS_URL_PREFIX', '/_sijax')
+            app.register_blueprint(_create_assets_blueprint(), url_prefix=url_prefix)
+        if hasattr(app, 'add_template_global'):
+            app.add_template_global(sijax_asset_url)
+
+        if state.profiler is not None:
+            profiling_url = app.config.get('SIJAX_PROFILING_URL', None)
+            if profiling_url is not None:
+                if state.profiler.token is None:
+                    raise ValueError('SIJAX_PROFILING_URL requires SIJAX_PROFILING_TOKEN!')
+                app.register_blueprint(_create_profiling_blueprint(), url_prefix=profiling_url)
+
+        if hasattr(app, 'cli'):
+            app.cli.add_command(_get_cli())
 
         app.extensions = getattr(app, 'extensions', {})
         app.extensions['sijax'] = self
+        app.extensions['sijax_state'] = state
+
+    @property
+    def _state(self):
+        """The :class:`_SijaxState` of the current application."""
+        return current_app.extensions['sijax_state']
+
+    @property
+    def _registry(self):
+        """The :class:`_Registry` of the current request."""
+        registry = g.get('_sijax_registry', None) if has_app_context() else None
+        if registry is None:
+            raise AttributeError('Sijax is only available while handling a request!')
+        return registry
+
+    @property
+    def _sijax(self):
+        """The underlying :class:`sijax.Sijax` object of the current request."""
+        return self._registry.sijax
+
+    @property
+    def _policies(self):
+        """Policies for the callbacks registered during the current request
+        (public name => :class:`_CallbackPolicy`)"""
+        return self._registry.policies
 
     def _on_before_request(self):
+        import sijax
+
+        state = current_app.extensions['sijax_state']
+
         g.sijax = self
 
-        self._sijax = sijax.Sijax()
-        self._sijax.set_data(request.form)
+        sijax_instance = sijax.Sijax()
+        sijax_instance.set_data(request.form)
+        sijax_instance.register_event(self.__class__.EVENT_BUSY, _busy_handler)
+        sijax_instance.register_event(self.__class__.EVENT_TIMEOUT, _timeout_handler)
+        sijax_instance.register_event(self.__class__.EVENT_INVALID_ARGS, _invalid_args_handler)
+
+        registry = g._sijax_registry = _Registry(state, sijax_instance)
+        registry.fallbacks = state.get_blueprint_registries(request.endpoint,
+                                                            request.blueprints)
 
-        url_relative = request.url[len(request.host_url) - 1:]
-        self._sijax.set_request_uri(url_relative)
+        if state.profiler is not None:
+            g._sijax_profile = state.profiler.should_profile(request)
 
-        if self._json_uri is not None:
-            self._sijax.set_json_uri(self._json_uri)
+        request_uri, json_uri = _get_client_uris(state, registry.fallbacks)
+        if request_uri is None:
+            request_uri = _get_request_uri(request.environ)
+        sijax_instance.set_request_uri(request_uri)
+
+        if json_uri is not None:
+            sijax_instance.set_json_uri(json_uri)
 
     def set_request_uri(self, uri):
         """Changes the request URI from the automatically detected one.
@@ -62,27 +2151,65 @@ class Sijax(object):
         """
         self._sijax.set_request_uri(uri)
 
-    def register_callback(self, *args, **kwargs):
+    def register_callback(self, public_name, callback, response_class=None,
+                          args_extra=None, **kwargs):
         """Registers a single callback function.
 
         Refer to :meth:`sijax.Sijax.register_callback`
-        for more details - this is a direct proxy to it.
+        for more details - this is a proxy to it.
+
+        Besides the options that Sijax knows about, the following
+        Flask-Sijax specific ones are accepted:
+
+        * ``max_concurrent`` - how many calls to this function
+          are allowed to run at the same time
+        * ``rate`` - a ``(calls, seconds)`` tuple limiting how many calls
+          to this function may be started within each period of ``seconds``
+        * ``timeout`` - the number of seconds the function is allowed to run
+          (defaults to the ``SIJAX_CALLBACK_TIMEOUT`` config value)
+        * ``validate`` - whether to check (and convert) the arguments coming
+          from the browser according to the function's signature and type hints
+          (defaults to the ``SIJAX_VALIDATE_ARGS`` config value)
+
+        Calls going over these limits are rejected before
+        the function is executed and the :attr:`EVENT_BUSY`
+        event handler is called instead.
+        By default, it makes the browser retry the call later.
+        Limits are enforced per process, unless a shared
+        :class:`LimitStore` is configured as ``SIJAX_LIMIT_STORE``.
+
+        Functions that don't complete in time are abandoned and
+        the :attr:`EVENT_TIMEOUT` event handler is called.
+        Regular functions with a timeout run in a thread pool
+        (of ``SIJAX_TIMEOUT_WORKERS`` threads), coroutine functions
+        (``async def``) are cancelled and streaming functions
+        are checked every time they yield.
+
+        Calls with arguments that don't fit the signature of a function
+        registered with ``validate`` are rejected before the function
+        is executed and the :attr:`EVENT_INVALID_ARGS` event handler
+        is called instead. ``int``, ``float``, ``str`` and ``bool``
+        arguments are converted from strings and numbers where possible,
+        ``list``, ``dict`` and ``Optional`` hints are checked recursively.
+        Unsupported type hints raise a ``TypeError`` on registration.
         """
-        self._sijax.register_callback(*args, **kwargs)
+        self._registry.register_callback(public_name, callback, response_class=response_class,
+                                         args_extra=args_extra, **kwargs)
 
-    def register_object(self, *args, **kwargs):
+    def register_object(self, obj, **kwargs):
         """Registers all "public" callable attributes of the given object.
 
         The object could be anything (module, class, class instance, etc.)
 
         This makes mass registration of functions a lot easier.
 
-        Refer to :meth:`sijax.Sijax.register_object`
-        for more details - this is a direct proxy to it.
+        Refer to :meth:`sijax.Sijax.register_object` for more details.
+        The options are the same as for :meth:`register_callback`
+        and apply to each of the functions.
         """
-        self._sijax.register_object(*args, **kwargs)
+        self._registry.register_object(obj, **kwargs)
 
-    def register_comet_callback(self, *args, **kwargs):
+    def register_comet_callback(self, public_name, callback, **kwargs):
         """Registers a single Comet callback function
         (see :ref:`comet-plugin`).
 
@@ -93,10 +2220,12 @@ class Sijax(object):
         argument that :func:`sijax.plugin.comet.register_comet_callback`
         expects is the Sijax instance, and this method
         does that automatically, so you don't have to do it.
+        The Flask-Sijax specific options of :meth:`register_callback`
+        are accepted too.
         """
-        sijax.plugin.comet.register_comet_callback(self._sijax, *args, **kwargs)
+        self._registry.register_comet_callback(public_name, callback, **kwargs)
 
-    def register_comet_object(self, *args, **kwargs):
+    def register_comet_object(self, obj, **kwargs):
         """Registers all functions from the object as Comet functions
         (see :ref:`comet-plugin`).
 
@@ -110,9 +2239,9 @@ class Sijax(object):
         expects is the Sijax instance, and this method
         does that automatically, so you don't have to do it.
         """
-        sijax.plugin.comet.register_comet_object(self._sijax, *args, **kwargs)
+        self._registry.register_comet_object(obj, **kwargs)
 
-    def register_upload_callback(self, *args, **kwargs):
+    def register_upload_callback(self, form_id, callback, **kwargs):
         """Registers an Upload function (see :ref:`upload-plugin`)
         to handle a certain form.
 
@@ -126,11 +2255,12 @@ class Sijax(object):
 
             def func(obj_response, files, form_values)
 
+        The Flask-Sijax specific options of :meth:`register_callback`
+        are accepted too.
+
         :return: string - javascript code that initializes the form
         """
-        if 'args_extra' not in kwargs:
-            kwargs['args_extra'] = [request.files]
-        return sijax.plugin.upload.register_upload_callback(self._sijax, *args, **kwargs)
+        return self._registry.register_upload_callback(form_id, callback, **kwargs)
 
     def register_event(self, *args, **kwargs):
         """Registers a new event handler.
@@ -153,25 +2283,284 @@ class Sijax(object):
         """Processes the Sijax request and returns the proper response.
 
         Refer to :meth:`sijax.Sijax.process_request` for more details.
+
+        Functions registered during the request take precedence over
+        the ones registered with the :class:`SijaxRegistry` of the blueprint
+        the current endpoint belongs to.
+
+        Functions registered with limits (see :meth:`register_callback`)
+        are only executed if the limits allow it.
+
+        When ``SIJAX_IDEMPOTENCY_TTL`` is set, calls retried with the same
+        idempotency key get the response of the original call
+        (waiting for it to finish, if needed), instead of running
+        the function again.
+        """
+        registry = self._registry
+        func_name = registry.sijax.requested_function
+        policy = registry.resolve(func_name)
+
+        state = registry.state
+        key = _get_idempotency_key(registry.sijax, state, func_name, policy)
+        while key is not None:
+            if state.idempotency_store.add(key, '', state.idempotency_ttl):
+                break
+            response = state.idempotency_store.wait(key, state.idempotency_wait)
+            if response == '':
+                # The original call is taking too long - try again later
+                return self._execute_event(policy, self.__class__.EVENT_BUSY,
+                                           func_name, state.busy_retry_after)
+            if response is not None:
+                return _make_response(response)
+            # The original call failed - take its place
+
+        try:
+            response = self._process_request(registry, func_name, policy)
+        except:
+            if key is not None:
+                state.idempotency_store.delete(key)
+            raise
+
+        if key is not None:
+            if isinstance(response, Response):
+                # Rejected because of the limits, so a retry should run it
+                state.idempotency_store.delete(key)
+            else:
+                state.idempotency_store.set(key, response[0], state.idempotency_ttl)
+
+        if isinstance(response, Response):
+            return response
+        return _make_response(*response)
+
+    def _process_request(self, registry, func_name, policy):
+        """Executes the requested function, enforcing its limits.
+
+        :return: the ``(sijax_response, clean_up)`` arguments
+                 for :func:`_make_response`, or a Flask response
+                 if the call was rejected
         """
-        response = self._sijax.process_request()
+        if policy is None or not policy.is_limited:
+            return registry.sijax.process_request(), None
+
+        store = registry.state.limit_store
+        retry_after = policy.acquire(store, registry.state.busy_retry_after)
+        if retry_after is not None:
+            return self._execute_event(policy, self.__class__.EVENT_BUSY,
+                                       func_name, retry_after)
+
+        slot = _ConcurrencySlot(lambda: policy.release(store))
+        token = _current_slot.set(slot)
+        try:
+            response = registry.sijax.process_request()
+        except:
+            slot.release()
+            raise
+        finally:
+            _current_slot.reset(token)
+        return response, slot.release
+
+    def _execute_event(self, policy, event_name, *event_args):
+        """Executes an event handler in place of the requested function,
+        using the response class the requested function was registered with.
+        """
+        handler = self._sijax.get_event(event_name)
+
+        def callback(obj_response, *args):
+            return handler(obj_response, *event_args)
+
+        response = self._sijax.execute_callback(self._sijax.request_args, callback,
+                                                 response_class=policy.response_class)
         return _make_response(response)
 
-    def execute_callback(self, *args, **kwargs):
+    def execute_callback(self, args, callback, **kwargs):
         """Executes a callback and returns the proper response.
 
         Refer to :meth:`sijax.Sijax.execute_callback` for more details.
+
+        The ``timeout`` and ``validate`` options are accepted too
+        (see :meth:`register_callback`).
         """
-        response = self._sijax.execute_callback(*args, **kwargs)
+        state = self._state
+        policy_options = dict((k, kwargs.pop(k)) for k in ('timeout', 'validate') if k in kwargs)
+        response_class = _get_response_class(kwargs.get('response_class'))
+        kwargs['response_class'] = response_class
+        policy = _CallbackPolicy(getattr(callback, '__name__', None), response_class,
+                                 policy_options, state.callback_timeout, state.validate_args)
+        callback = policy.wrap(callback, state.timeout_pool, state.profiler,
+                               kwargs.get('args_extra'))
+        response = self._sijax.execute_callback(args, callback, **kwargs)
         return _make_response(response)
 
+    def render_fragment(self, obj_response, selector, template_name,
+                        cache_key=None, ttl=None, **context):
+        """Renders a template and assigns the result as the html value
+        of all elements matching the jQuery selector.
+
+        This works like::
+
+            obj_response.html(selector, render_template(template_name, **context))
+
+        but the rendered fragments are cached (if a ``cache_key`` is given),
+        so that identical fragments are not rendered again for every user.
+
+        The browser remembers the last few fragments it received.
+        When it already has the same version of the fragment,
+        only a short reference to it is sent instead of the whole html.
+
+        Example::
+
+            def refresh(obj_response):
+                g.sijax.render_fragment(obj_response, '#news', 'news.html',
+                                        cache_key='news', ttl=60, news=get_news())
+
+        Keep in mind that ``context`` is not part of the cache key.
+        Everything that makes the rendered html differ needs to be
+        in ``cache_key``, or you'd be sending the wrong html to some users.
+
+        :param obj_response: the response object of the Sijax function
+        :param selector: the jQuery selector for which we'll replace the html
+        :param template_name: the name of the template to render
+        :param cache_key: identifies this rendering of the template, or ``None``
+                          to always render it
+        :param ttl: the number of seconds to cache the rendered fragment for
+                    (defaults to the ``SIJAX_FRAGMENT_CACHE_TTL`` config value)
+        :param context: the variables to render the template with
+        """
+        cached = None
+        if cache_key is not None:
+            key = (template_name, cache_key)
+            cached = self._state.fragment_cache.get(key)
+
+        if cached is None:
+            html = render_template(template_name, **context)
+            version = hashlib.sha1(html.encode('utf-8')).hexdigest()[:12]
+            if cache_key is not None:
+                if ttl is None:
+                    ttl = self._state.fragment_ttl
+                self._state.fragment_cache.set(key, (html, version), ttl)
+        else:
+            html, version = cached
+
+        if version in self._get_client_fragments():
+            html = None
+        return obj_response.call('Sijax.fragment', [selector, html, version])
+
+    def _get_client_fragments(self):
+        """Returns the versions of the fragments that the browser holds."""
+        versions = request.form.get(PARAM_FRAGMENTS, '')
+        return set(versions.split(',')) if versions else set()
+
     def get_js(self):
         """Returns the javascript code that sets up the client for this request.
 
         This code is request-specific, be sure to put it on each page that needs
         to use Sijax.
         """
-        return self._sijax.get_js()
+        return self._sijax.get_js() + _CLIENT_JS
+
+
+#: The :class:`SijaxRegistry` of each blueprint
+_blueprint_registries = weakref.WeakKeyDictionary()
+
+
+class SijaxRegistry(object):
+    """Sijax functions of a blueprint, registered once, instead of on every request.
+
+    Requests to the blueprint's endpoints can call these functions,
+    once :meth:`Sijax.process_request` is called::
+
+        admin = Blueprint('admin', __name__)
+        admin_sijax = flask_sijax.SijaxRegistry(admin)
+        admin_sijax.register_object(AdminHandlers)
+
+        @flask_sijax.route(admin, '/')
+        def index():
+            if g.sijax.is_sijax_request:
+                return g.sijax.process_request()
+            return render_template('admin.html')
+
+    Functions registered during the request (with ``g.sijax``) take
+    precedence over the blueprint's ones. With nested blueprints,
+    the registries of the inner blueprints take precedence.
+
+    The registration methods are the same as :class:`Sijax`'s ones.
+    They only record what is to be registered, which is done
+    (once for each application) when the blueprint is registered
+    with an application or when first needed. Functions registered
+    later on are picked up by the next request.
+
+    :param blueprint: the blueprint that the functions belong to
+    :param request_uri: the URI that the pages of the blueprint send their
+                        Sijax requests to, instead of their own URI
+    :param json_uri: the URI to load ``json2.js`` from on the pages of the
+                     blueprint, instead of the ``SIJAX_JSON_URI`` config value
+    """
+
+    def __init__(self, blueprint, request_uri=None, json_uri=None):
+        self.blueprint = blueprint
+        self.request_uri = request_uri
+        self.json_uri = json_uri
+
+        #: The registration methods to call (name, args, kwargs)
+        self._registrations = []
+
+        _blueprint_registries[blueprint] = self
+        blueprint.record_once(self._on_blueprint_registered)
+
+    def _on_blueprint_registered(self, setup_state):
+        state = setup_state.app.extensions.get('sijax_state')
+        if state is not None:
+            state.get_registry(self)
+
+    def _build(self, state):
+        """Registers the functions, according to the application ``state``."""
+        import sijax
+
+        registry = _Registry(state, sijax.Sijax(), deferred=True)
+        registry.request_uri = self.request_uri
+        registry.json_uri = self.json_uri
+        registry.source = self
+        self._update(registry)
+        return registry
+
+    def _is_newer(self, registry):
+        """Tells whether functions were registered since the registry was built."""
+        return registry.applied < len(self._registrations)
+
+    def _update(self, registry):
+        """Registers the functions added since the registry was built."""
+        for method_name, args, kwargs in self._registrations[registry.applied:]:
+            getattr(registry, method_name)(*args, **dict(kwargs))
+            registry.applied += 1
+
+    def register_callback(self, public_name, callback, **kwargs):
+        """See :meth:`Sijax.register_callback`."""
+        self._registrations.append(('register_callback', (public_name, callback), kwargs))
+
+    def register_object(self, obj, **kwargs):
+        """See :meth:`Sijax.register_object`."""
+        self._registrations.append(('register_object', (obj,), kwargs))
+
+    def register_comet_callback(self, public_name, callback, **kwargs):
+        """See :meth:`Sijax.register_comet_callback`."""
+        self._registrations.append(('register_comet_callback', (public_name, callback), kwargs))
+
+    def register_comet_object(self, obj, **kwargs):
+        """See :meth:`Sijax.register_comet_object`."""
+        self._registrations.append(('register_comet_object', (obj,), kwargs))
+
+    def register_upload_callback(self, form_id, callback, **kwargs):
+        """See :meth:`Sijax.register_upload_callback`.
+
+        :return: string - javascript code that initializes the form
+        """
+        import sijax
+        from sijax.plugin import upload
+
+        self._registrations.append(('register_upload_callback', (form_id, callback), kwargs))
+        # The javascript code doesn't depend on the request,
+        # so it's made by registering with a throwaway Sijax object
+        return upload.register_upload_callback(sijax.Sijax(), form_id, callback)
 
 
 def route(app_or_blueprint, rule, **options):
@@ -207,32 +2596,651 @@ def route(app_or_blueprint, rule, **options):
     return decorator
 
 
-def _make_response(sijax_response):
+#: The files :func:`deploy_static_files` mirrors,
+#: relative to the directory of the sijax package
+_STATIC_FILES = (
+    'js/sijax.js',
+    'js/json2.js',
+    'plugin/comet/js/sijax_comet.js',
+    'plugin/upload/js/sijax_upload.js',
+)
+
+#: Keeps track of what was deployed to a static path.
+#: It has the same name that :func:`sijax.helper.init_static_path` uses,
+#: so that directories previously managed by it are recognized.
+_STATIC_STAMP_FILE = 'sijax_version'
+
+_STATIC_LOCK_FILE = '.sijax_lock'
+
+
+def _get_static_sources():
+    """Returns a list of ``(file name, source path)`` pairs for the files
+    that need to be deployed.
+
+    The sijax package is only located, not imported."""
+    package_dir = os.path.dirname(find_spec('sijax').origin)
+    return [(os.path.basename(path), os.path.join(package_dir, path))
+            for path in _STATIC_FILES]
+
+
+def _get_file_checksum(path):
+    with open(path, 'rb') as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+
+def _write_file_atomically(path, data):
+    """Writes the file in a way that never leaves a partially written
+    (or missing) file behind for someone to serve."""
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        fp.write(data)
+    os.rename(tmp_path, path)
+
+
+def deploy_static_files(static_path):
+    """Mirrors the Sijax javascript files into the given directory.
+
+    This is what the ``SIJAX_STATIC_PATH`` config option does
+    when the application is initialized. It works like
+    :func:`sijax.helper.init_static_path`, but doesn't rewrite
+    the files on every start:
+
+    - if nothing changed since the last deployment (which is detected
+      by looking at the size and modification time of the source files,
+      and at the size of the deployed ones), nothing but a single small
+      file is read
+    - otherwise, only the files whose checksums differ are replaced
+      (atomically), while holding a lock so that only one of the processes
+      starting at the same time does the work
+
+    To deploy the files once (as part of your deployment process) rather
+    than when each process starts, call this (or run ``flask sijax deploy-static``)
+    and set the ``SIJAX_STATIC_DEPLOY`` config option to ``False``.
+
+    The directory needs to be dedicated to these files.
+    A :class:`sijax.exception.SijaxError` is raised if it contains
+    other files and was not previously used by Sijax.
+
+    :return: ``True`` if any file was written, ``False`` otherwise
+    """
+    sources = _get_static_sources()
+
+    fingerprint, sizes = [], {}
+    for file_name, src_path in sources:
+        stat = os.stat(src_path)
+        fingerprint.append('%s:%d:%d' % (file_name, stat.st_size, stat.st_mtime))
+        sizes[file_name] = stat.st_size
+    fingerprint = ' '.join(fingerprint)
+
+    stamp_path = os.path.join(static_path, _STATIC_STAMP_FILE)
+
+    def is_current():
+        try:
+            with open(stamp_path) as fp:
+                if fp.read() != fingerprint:
+                    return False
+            # Deployed files may have been deleted or truncated since
+            for file_name, size in sizes.items():
+                if os.stat(os.path.join(static_path, file_name)).st_size != size:
+                    return False
+            return True
+        except (IOError, OSError):
+            return False
+
+    if is_current():
+        return False
+
+    if not os.path.exists(static_path):
+        os.makedirs(static_path)
+
+    lock_fp = open(os.path.join(static_path, _STATIC_LOCK_FILE), 'w')
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX)
+
+        # Another process may have done the work while we were waiting
+        if is_current():
+            return False
+
+        file_names = set(file_name for file_name, _ in sources)
+        existing = set(os.listdir(static_path)) - set([_STATIC_LOCK_FILE])
+        if existing and _STATIC_STAMP_FILE not in existing:
+            # Looks like a user directory - we'd better not touch anything!
+            from sijax.exception import SijaxError
+            raise SijaxError('%s already contains files - refusing to write there!' %
+                             static_path)
+
+        for file_name in existing - file_names - set([_STATIC_STAMP_FILE]):
+            # Left over from another Sijax version
+            os.unlink(os.path.join(static_path, file_name))
+
+        for file_name, src_path in sources:
+            dst_path = os.path.join(static_path, file_name)
+            if (file_name in existing and
+                    _get_file_checksum(dst_path) == _get_file_checksum(src_path)):
+                continue
+            with open(src_path, 'rb') as fp:
+                _write_file_atomically(dst_path, fp.read())
+
+        _write_file_atomically(stamp_path, fingerprint.encode('utf-8'))
+        return True
+    finally:
+        lock_fp.close()
+
+
+#: Sets the request URI of pages using a bundle built by
+#: :func:`build_bootstrap_bundles`. It's the ``data-sijax-uri`` attribute
+#: of the bundle's ``<script>`` tag (or of ``<html>``), the URI the bundle
+#: was built with (the ``%s`` placeholder), or the URI of the page itself.
+_BOOTSTRAP_URI_JS = (
+    '(function(){var s=document.currentScript,'
+    'uri=(s&&s.getAttribute("data-sijax-uri"))||'
+    'document.documentElement.getAttribute("data-sijax-uri")||%s||'
+    'window.location.pathname+window.location.search;'
+    'Sijax.setRequestUri(uri);})();'
+)
+
+#: The file listing the bundle of each route,
+#: written by :func:`build_bootstrap_bundles`
+_BOOTSTRAP_MANIFEST_FILE = 'manifest.json'
+
+
+def build_bootstrap_bundles(output_path):
+    """Writes static javascript bundles that set up the client,
+    for the pages of the current application.
+
+    Unlike :meth:`Sijax.get_js`, a bundle doesn't depend on the request,
+    so pages using it can be cached as a whole (or served from a CDN).
+    Each bundle contains ``sijax.js`` (along with the Comet and Upload plugins)
+    and the setup code. Instead of having the request URI written into it,
+    the bundle finds it out in the browser, from the ``data-sijax-uri``
+    attribute of its ``<script>`` tag (or of the ``<html>`` tag),
+    falling back to the request URI of the blueprint's :class:`SijaxRegistry`
+    or else to the URI of the page itself::
+
+        <script src="//cdn.example.com/sijax-bootstrap.0123456789ab.js"
+                data-sijax-uri="/sijax"></script>
+
+    One bundle is written for each of the configurations found among the routes
+    that accept both ``GET`` and ``POST`` requests (see :func:`route`).
+    Their names contain a hash of their contents. ``manifest.json``
+    maps each route's rule to the name of its bundle.
+
+    This needs an application context (the ``flask sijax build``
+    command does this for the current application).
+
+    :return: the manifest (rule => bundle file name)
+    """
+    from sijax.helper import json
+
+    state = current_app.extensions['sijax_state']
+
+    runtime = []
+    for file_name, src_path in _get_static_sources():
+        if file_name != 'json2.js':
+            with open(src_path, 'rb') as fp:
+                runtime.append(fp.read().decode('utf-8'))
+    runtime = '\n'.join(runtime) + '\n'
+
+    bundles, manifest = {}, {}
+    with current_app.test_request_context():
+        for rule in current_app.url_map.iter_rules():
+            methods = rule.methods or ()
+            if 'GET' not in methods or 'POST' not in methods:
+                continue
+
+            names = _get_endpoint_blueprint_names(rule.endpoint)
+            request_uri, json_uri = _get_client_uris(
+                state, state.get_blueprint_registries(rule.endpoint, names))
+
+            js = runtime + _BOOTSTRAP_URI_JS % json.dumps(request_uri)
+            if json_uri is not None:
+                js += 'Sijax.setJsonUri(%s);' % json.dumps(json_uri)
+            data = (js + _CLIENT_JS).encode('utf-8')
+
+            name = 'sijax-bootstrap.%s.js' % hashlib.sha1(data).hexdigest()[:12]
+            bundles[name] = data
+            manifest[rule.rule] = name
+
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+    for name, data in bundles.items():
+        _write_file_atomically(os.path.join(output_path, name), data)
+    _write_file_atomically(os.path.join(output_path, _BOOTSTRAP_MANIFEST_FILE),
+                           json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+class _Asset(object):
+    """A javascript file kept in memory, along with its compressed variants."""
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.etag = hashlib.sha1(data).hexdigest()[:12]
+
+        base, ext = os.path.splitext(name)
+        self.fingerprinted_name = '%s.%s%s' % (base, self.etag, ext)
+
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as fp:
+            fp.write(data)
+        self.gzip = buf.getvalue()
+
+        try:
+            import brotli
+        except ImportError:
+            self.br = None
+        else:
+            self.br = brotli.compress(data)
+
+    def get_variant(self, accept_encodings):
+        """Returns the ``(data, content encoding)`` pair to serve
+        for the given ``Accept-Encoding`` request header."""
+        if self.br is not None and accept_encodings['br']:
+            return self.br, 'br'
+        if accept_encodings['gzip']:
+            return self.gzip, 'gzip'
+        return self.data, None
+
+
+_assets = None
+_assets_lock = threading.Lock()
+
+
+def _get_assets():
+    """Returns a dictionary of the in-memory javascript files,
+    keyed by both their plain and fingerprinted names.
+    The files are loaded when first needed."""
+    global _assets
+    with _assets_lock:
+        if _assets is None:
+            assets = {}
+            for file_name, src_path in _get_static_sources():
+                with open(src_path, 'rb') as fp:
+                    asset = _Asset(file_name, fp.read())
+                assets[asset.name] = asset
+                assets[asset.fingerprinted_name] = asset
+            _assets = assets
+        return _assets
+
+
+def _serve_asset(filename):
+    asset = _get_assets().get(filename)
+    if asset is None:
+        abort(404)
+
+    data, encoding = asset.get_variant(request.accept_encodings)
+    response = Response(data, mimetype='application/javascript')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+        response.set_etag('%s-%s' % (asset.etag, encoding))
+    else:
+        response.set_etag(asset.etag)
+    response.vary.add('Accept-Encoding')
+
+    if filename == asset.fingerprinted_name:
+        # The content behind this URL never changes
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+
+    return response.make_conditional(request)
+
+
+def _create_assets_blueprint():
+    blueprint = Blueprint('sijax', __name__)
+    blueprint.add_url_rule('/<filename>', 'asset', _serve_asset)
+    return blueprint
+
+
+def _get_profiler():
+    """Returns the profiler of the current app,
+    aborting unless the request carries the profiling token."""
+    profiler = current_app.extensions['sijax_state'].profiler
+    token = request.headers.get(profiler.header) if profiler.header else None
+    if not profiler.is_authorized(token or request.args.get('token')):
+        abort(403)
+    return profiler
+
+
+def _list_profiles():
+    entries = _get_profiler().get_entries(request.args.get('name'))
+    return jsonify([dict((k, v) for k, v in entry.items() if k != 'data')
+                    for entry in entries])
+
+
+def _download_profile(profile_id):
+    entry = _get_profiler().get_entry(profile_id)
+    if entry is None:
+        abort(404)
+    response = Response(entry['data'], mimetype='application/octet-stream')
+    filename = '%s-%d.prof' % (entry['name'], entry['id'])
+    response.headers['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+
+def _create_profiling_blueprint():
+    blueprint = Blueprint('sijax_profiling', __name__)
+    blueprint.add_url_rule('/', 'list', _list_profiles)
+    blueprint.add_url_rule('/<int:profile_id>.prof', 'download', _download_profile)
+    return blueprint
+
+
+def sijax_asset_url(filename):
+    """Returns the URL of a Sijax javascript file (``sijax.js``, ``json2.js``,
+    ``sijax_comet.js`` or ``sijax_upload.js``), served from memory when
+    the ``SIJAX_SERVE_ASSETS`` config option is enabled.
+
+    The URL contains a hash of the file contents, so it's cached
+    by browsers for as long as the file doesn't change.
+
+    This function is also available in templates::
+
+        <script type="text/javascript" src="{{ sijax_asset_url('sijax.js') }}"></script>
+    """
+    state = current_app.extensions.get('sijax_state')
+    if state is None or not state.serve_assets:
+        raise RuntimeError('Sijax assets are only available '
+                           'with SIJAX_SERVE_ASSETS enabled!')
+
+    asset = _get_assets().get(filename)
+    if asset is None:
+        raise ValueError('Unknown Sijax asset: %s' % filename)
+    return url_for('sijax.asset', filename=asset.fingerprinted_name)
+
+
+_cli = None
+
+
+def _get_cli():
+    """Returns the ``flask sijax`` command group."""
+    global _cli
+    if _cli is not None:
+        return _cli
+
+    cli = AppGroup('sijax', help='Flask-Sijax commands.')
+
+    @cli.command('deploy-static')
+    def deploy_static_command():
+        """Deploys the Sijax javascript files to SIJAX_STATIC_PATH."""
+        static_path = current_app.config.get('SIJAX_STATIC_PATH', None)
+        if static_path is None:
+            raise click.UsageError('SIJAX_STATIC_PATH is not configured.')
+        if deploy_static_files(static_path):
+            click.echo('Deployed the Sijax files to %s' % static_path)
+        else:
+            click.echo('The Sijax files in %s are up to date' % static_path)
+
+    @cli.command('build')
+    @click.argument('output_path', type=click.Path(file_okay=False))
+    def build_command(output_path):
+        """Writes static client bootstrap bundles to OUTPUT_PATH."""
+        manifest = build_bootstrap_bundles(output_path)
+        click.echo('Wrote %d bundle(s) for %d route(s) to %s'
+                   % (len(set(manifest.values())), len(manifest), output_path))
+
+    _cli = cli
+    return cli
+
+
+#: Attribute that :func:`sijax_callback` sets on the functions it marks
+_MARKER_ATTR = '_sijax_public_name'
+
+#: Names of the callables found on classes and modules (object =>
+#: (snapshot, list of (public name, attribute name) pairs, is plain))
+_public_names_cache = weakref.WeakKeyDictionary()
+
+
+def sijax_callback(public_name=None):
+    """Marks a method (or function) as a Sijax callback.
+
+    When registering an object with :meth:`Sijax.register_object` (or
+    :meth:`Sijax.register_comet_object`), only the marked attributes are
+    registered if the object's class (or module) has any of them marked.
+    Otherwise all "public" callable attributes are registered.
+
+    Example::
+
+        class Handlers(object):
+            @flask_sijax.sijax_callback
+            def save(self, obj_response, message):
+                pass
+
+            @flask_sijax.sijax_callback('clear')
+            def clear_messages(self, obj_response):
+                pass
+
+            def helper(self):
+                # Not exposed to the browser
+                pass
+
+    Another way to skip attribute discovery is to list the attribute names
+    in a ``__sijax_callbacks__`` attribute (a list of names, or a dictionary
+    of public names => attribute names).
+
+    :param public_name: the name to expose the function with
+                        (defaults to the attribute name)
+    """
+    def decorator(func):
+        setattr(func, _MARKER_ATTR, public_name)
+        return func
+
+    if callable(public_name):
+        func, public_name = public_name, None
+        return decorator(func)
+    return decorator
+
+
+def _get_namespaces(owner):
+    return owner.__mro__ if isinstance(owner, type) else (owner,)
+
+
+def _take_snapshot(owner):
+    """Returns the ``(name, value, marker)`` triples of the attributes of
+    the given class (and its bases) or module. Values are weakly referenced
+    where possible, so that the snapshot doesn't keep them alive."""
+    snapshot = []
+    for namespace in _get_namespaces(owner):
+        for name, value in vars(namespace).items():
+            marker = getattr(value, _MARKER_ATTR, False)
+            try:
+                value = weakref.ref(value)
+            except TypeError:
+                pass
+            snapshot.append((name, value, marker))
+    return snapshot
+
+
+def _is_snapshot_current(snapshot, owner):
+    """Tells whether no attribute was added, removed, replaced
+    or marked (see :func:`sijax_callback`) since the snapshot was taken."""
+    index = 0
+    for namespace in _get_namespaces(owner):
+        for name, value in vars(namespace).items():
+            if index == len(snapshot):
+                return False
+            old_name, old_value, old_marker = snapshot[index]
+            if type(old_value) is weakref.ref:
+                old_value = old_value()
+            if (old_name != name or old_value is not value or
+                    old_marker != getattr(value, _MARKER_ATTR, False)):
+                return False
+            index += 1
+    return index == len(snapshot)
+
+
+#: Descriptors which don't make attributes depend on the instance
+_PLAIN_DESCRIPTORS = (types.FunctionType, staticmethod, classmethod, types.GetSetDescriptorType)
+
+
+def _is_plain_class(cls):
+    """Tells whether the callable attributes of the instances of the class
+    are those of the class, unless stored on the instances themselves
+    (no properties, slots, ``__getattr__``, etc.)."""
+    for namespace in cls.__mro__[:-1]:
+        for name, value in vars(namespace).items():
+            if name in ('__getattr__', '__getattribute__', '__dir__'):
+                return False
+            if hasattr(type(value), '__get__') and not isinstance(value, _PLAIN_DESCRIPTORS):
+                return False
+    return True
+
+
+def _find_public_names(owner):
+    """Finds the callable attributes of an object the same way
+    :meth:`sijax.Sijax.register_object` does, honoring :func:`sijax_callback` markers."""
+    found, marked = [], []
+    for attr_name in dir(owner):
+        attribute = getattr(owner, attr_name, None)
+        if not hasattr(attribute, '__call__'):
+            continue
+        if hasattr(attribute, _MARKER_ATTR):
+            marked.append((getattr(attribute, _MARKER_ATTR) or attr_name, attr_name))
+        elif not attr_name.startswith('_'):
+            found.append((attr_name, attr_name))
+    return marked if marked else found
+
+
+def _get_public_names(owner):
+    """Returns the names of the callables found on the class or module
+    and whether it's a plain class (see :func:`_is_plain_class`)."""
+    try:
+        snapshot, names, plain = _public_names_cache[owner]
+    except (KeyError, TypeError):
+        pass
+    else:
+        if _is_snapshot_current(snapshot, owner):
+            return names, plain
+
+    names = _find_public_names(owner)
+    plain = isinstance(owner, type) and _is_plain_class(owner)
+    try:
+        _public_names_cache[owner] = (_take_snapshot(owner), names, plain)
+    except TypeError:
+        # Can't be weakly referenced - just don't cache it
+        pass
+    return names, plain
+
+
+def _get_public_callables(obj):
+    """Returns a list of ``(name, callable)`` pairs for
+    all "public" callable attributes of the given object,
+    the same way :meth:`sijax.Sijax.register_object` finds them.
+
+    The names are looked up once per class (or module) and cached until
+    any of its attributes changes, unless the object lists them in
+    ``__sijax_callbacks__`` (see :func:`sijax_callback`). Instances
+    whose attributes don't all come from their class are looked at directly."""
+    manifest = getattr(obj, '__sijax_callbacks__', None)
+    if manifest is not None:
+        if isinstance(manifest, dict):
+            return [(public_name, getattr(obj, attr_name))
+                    for public_name, attr_name in manifest.items()]
+        return [(attr_name, getattr(obj, attr_name)) for attr_name in manifest]
+
+    if isinstance(obj, (type, types.ModuleType)):
+        names, _ = _get_public_names(obj)
+    else:
+        names, plain = _get_public_names(type(obj))
+        instance_vars = getattr(obj, '__dict__', None) or {}
+        if not plain or any(hasattr(value, '__call__') for value in instance_vars.values()):
+            names = _find_public_names(obj)
+    return [(public_name, getattr(obj, attr_name)) for public_name, attr_name in names]
+
+
+def _stream_with_context(generator, clean_up=None):
+    """Wraps a streaming response generator, keeping the current request
+    context alive until the stream is exhausted or closed.
+
+    This works like :func:`flask.stream_with_context` did up to Flask 2.2.
+    Newer versions only push the context once iteration starts,
+    which is after Flask has already torn it down and closed the uploaded files.
+
+    As per the WSGI specification, ``close()`` would be called on iterator
+    responses - that's when the handler generator is stopped, the context
+    is popped (releasing the request data and files) and the optional
+    ``clean_up`` callback is called.
+    """
+    ctx = request_ctx._get_current_object()
+
+    def stream():
+        try:
+            with ctx:
+                yield None
+                try:
+                    for chunk in generator:
+                        yield chunk
+                finally:
+                    generator.close()
+        finally:
+            if clean_up is not None:
+                clean_up()
+
+    # Run up to the first `yield`, so that the context gets pushed now
+    wrapped = stream()
+    next(wrapped)
+    return wrapped
+
+
+def _get_idempotency_key(sijax_instance, state, func_name, policy):
+    """Returns the key the response of the current call is kept under,
+    in the :class:`IdempotencyStore`, or ``None`` if it shouldn't be kept.
+
+    Only calls to known non-streaming functions which came with
+    an idempotency key are kept. The function's name, its arguments,
+    the path and the user (see ``SIJAX_IDEMPOTENCY_SCOPE``) are part
+    of the key, so that a key sent again for something else,
+    or by someone else, doesn't get the wrong response.
+    """
+    if not state.idempotency_ttl or policy is None:
+        return None
+    if (policy.response_class is not None and
+            issubclass(policy.response_class, _StreamingResponseMixin)):
+        return None
+
+    data = sijax_instance.get_data()
+    client_key = data.get(PARAM_IDEMPOTENCY_KEY)
+    if not client_key:
+        return None
+
+    from sijax.helper import json
+
+    args = data.get(sijax_instance.__class__.PARAM_ARGS, '[]')
+    blob = json.dumps([request.path, func_name, args, client_key,
+                       state.idempotency_scope()])
+    return 'sijax:idempotency:%s' % hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+
+def _get_idempotency_scope():
+    """Default ``SIJAX_IDEMPOTENCY_SCOPE``: the session cookie
+    and the address of the client making the current call."""
+    cookie_name = current_app.config.get('SESSION_COOKIE_NAME', 'session')
+    return '%s|%s' % (request.cookies.get(cookie_name, ''),
+                      request.remote_addr or '')
+
+
+def _make_response(sijax_response, clean_up=None):
     """Takes a Sijax response object and returns a
-    valid Flask response object."""
-    from types import GeneratorType
+    valid Flask response object.
+
+    The optional ``clean_up`` callback is called when the response
+    is done with - immediately for regular responses, or when
+    the stream is closed for streaming ones."""
 
     if isinstance(sijax_response, GeneratorType):
         # Streaming response using a generator (non-JSON response).
         # Upon returning a response, Flask would automatically destroy
-        # the request data and uploaded files - done by `flask.ctx.RequestContext.auto_pop()`
+        # the request data and uploaded files when tearing down the request context.
         # We can't allow that, since the user-provided callback we're executing
         # from within the generator may want to access request data/files.
-        # That's why we'll tell Flask to preserve the context and we'll clean up ourselves.
-
-        request.environ['flask._preserve_context'] = True
-
-        # Clean-up code taken from `flask.testing.TestingClient`
-        def clean_up_context():
-            top = _request_ctx_stack.top
-            if top is not None and top.preserved:
-                top.pop()
-
-        # As per the WSGI specification, `close()` would be called on iterator responses.
-        # Let's wrap the iterator in another one, which will forward that `close()` call to our clean-up callback.
-        response = Response(ClosingIterator(sijax_response, clean_up_context), direct_passthrough=True)
+        # That's why we keep the request context pushed while streaming.
+        stream = _stream_with_context(sijax_response, clean_up)
+        response = Response(stream, direct_passthrough=True)
     else:
         # Non-streaming response - a single JSON string
+        if clean_up is not None:
+            clean_up()
         response = Response(sijax_response)
 
     return response
@@ -32,15 +32,14 @@ setup(
     platforms = "any",
     license = "BSD",
     py_modules = ['flask_sijax'],
-    install_requires = ['Flask>=0.7.0', 'Sijax>=0.3.0'],
+    python_requires = '>=3.8',
+    install_requires = ['Flask>=2.2', 'Sijax>=0.3.0'],
     test_suite = 'tests',
     zip_safe = False,
     classifiers = [
         "Programming Language :: Python",
-        "Programming Language :: Python :: 2.6",
-        "Programming Language :: Python :: 2.7",
-        "Programming Language :: Python :: 3.3",
-        "Programming Language :: Python :: 3.4",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
         "Development Status :: 5 - Production/Stable",
         "Environment :: Web Environment",
         "Intended Audience :: Developers",
@@ -106,6 +106,22 @@ class SijaxFlaskTestCase(unittest.TestCase):
             js = helper.get_js()
             self.assertTrue('Sijax.setRequestUri("/relative/url?query=string&is=here");' in js)
 
+    def test_request_uri_is_quoted_and_includes_the_mount_point(self):
+        app = flask.Flask(__name__)
+        helper = flask_sijax.Sijax(app)
+
+        cases = [
+            ('/', 'http://localhost/mounted/', '/mounted/'),
+            ('/a b/%C3%A5?q=%C3%A8 r&x=/?', 'http://localhost/', '/a%20b/%C3%A5?q=%C3%A8%20r&x=/?'),
+            (u'/p\xe5th', 'http://localhost/app/', '/app/p%C3%A5th'),
+            ('/<script>', 'http://localhost/', '/%3Cscript%3E'),
+        ]
+        for path, base_url, expected in cases:
+            with app.test_request_context(path, base_url=base_url):
+                app.preprocess_request()
+                self.assertTrue('Sijax.setRequestUri("%s");' % expected in helper.get_js(),
+                                helper.get_js())
+
     def test_registering_callbacks_in_a_non_request_context_fails(self):
         app = flask.Flask(__name__)
         helper = flask_sijax.Sijax(app)
@@ -229,5 +245,1233 @@ class SijaxFlaskTestCase(unittest.TestCase):
             response = helper.process_request()
             self.assertTrue(isinstance(response, flask.Response))
 
+    def test_max_concurrent_limit_rejects_calls_while_streams_are_open(self):
+        app = flask.Flask(__name__)
+        helper = flask_sijax.Sijax(app)
+
+        def comet_handler(obj_response, value):
+            obj_response.html('#progress', 'working')
+
+        call_history = []
+
+        def callback(obj_response):
+            call_history.append('callback')
+
+        with app.test_request_context():
+            app.preprocess_request()
+
+            cls_sijax = helper._sijax.__class__
+            helper._sijax.set_data({cls_sijax.PARAM_REQUEST: 'work', cls_sijax.PARAM_ARGS: '[5]'})
+
+            helper.register_comet_callback('work', comet_handler, max_concurrent=1)
+            stream = helper.process_request()
+
+            # The first stream is still open, so the second call gets rejected
+            # and the browser is told to retry it with the same arguments
+            response = helper.process_request()
+            body = b''.join(response.response).decode('utf-8')
+            self.assertTrue('"Sijax.busy","params":["work",[5],500,"comet"]' in body)
+            self.assertFalse('working' in body)
+
+            # Closing the first stream frees its slot
+            stream.close()
+            response = helper.process_request()
+            body = b''.join(response.response).decode('utf-8')
+            self.assertTrue('working' in body)
+            response.close()
+
+            # Regular callbacks release their slot as soon as they're done
+            helper._sijax.set_data({cls_sijax.PARAM_REQUEST: 'test', cls_sijax.PARAM_ARGS: '[]'})
+            helper.register_callback('test', callback, max_concurrent=1)
+            helper.process_request()
+            helper.process_request()
+            self.assertEqual(['callback', 'callback'], call_history)
+
+    def test_abandoned_callbacks_keep_their_concurrency_slot(self):
+        import threading
+        import time
+
+        app = flask.Flask(__name__)
+        helper = flask_sijax.Sijax(app)
+        release = threading.Event()
+
+        def callback(obj_response, wait):
+            if wait:
+                release.wait(5)
+            obj_response.alert('done')
+
+        with app.test_request_context():
+            app.preprocess_request()
+            helper.register_callback('test', callback, max_concurrent=1, timeout=0.05)
+
+            self._sijax_post(helper, 'test', '[1]')
+            self.assertTrue('took too long' in helper.process_request().get_data(True))
+
+            # The abandoned call is still running
+            self._sijax_post(helper, 'test', '[0]')
+            self.assertTrue('Sijax.busy' in helper.process_request().get_data(True))
+
+            release.set()
+            for _ in range(100):
+                body = helper.process_request().get_data(True)
+                if 'Sijax.busy' not in body:
+                    break
+                time.sleep(0.05)
+            self.assertTrue('done' in body)
+
+    def test_calls_rejected_as_busy_do_not_use_up_the_rate_limit(self):
+        app = flask.Flask(__name__)
+        helper = flask_sijax.Sijax(app)
+
+        def comet_handler(obj_response):
+            obj_response.html('#progress', 'working')
+
+        with app.test_request_context():
+            app.preprocess_request()
+            self._sijax_post(helper, 'work')
+            helper.register_comet_callback('work', comet_handler,
+                                           max_concurrent=1, rate=(2, 3600))
+
+            stream = helper.process_request()
+            for _ in range(3):
+                response = helper.process_request()
+                self.assertTrue('Sijax.busy' in b''.join(response.response).decode('utf-8'))
+            stream.close()
+
+            response = helper.process_request()
+            self.assertTrue('working' in b''.join(response.response).decode('utf-8'))
+            response.close()
+
+    def test_rate_limit_rejects_calls_with_a_busy_command(self):
+        from sijax.helper import json
+
+        app = flask.Flask(__name__)
+        helper = flask_sijax.Sijax(app)
+
+        call_history = []
+
+        def callback(obj_response):
+            call_history.append('callback')
+
+        with app.test_request_context():
+            app.preprocess_request()
+
+            cls_sijax = helper._sijax.__class__
+            helper._sijax.set_data({cls_sijax.PARAM_REQUEST: 'test', cls_sijax.PARAM_ARGS: '[1]'})
+            helper.register_callback('test', lambda r, a: callback(r), rate=(2, 3600))
+
+            helper.process_request()
+            helper.process_request()
+            response = helper.process_request()
+            self.assertEqual(['callback', 'callback'], call_history)
+
+            commands = json.loads(response.get_data(True))
+            self.assertEqual(1, len(commands))
+            self.assertEqual('Sijax.busy', commands[0]['call'])
+            func_name, args, delay, mode = commands[0]['params']
+            self.assertEqual(('test', [1], 'request'), (func_name, args, mode))
+            self.assertTrue(0 < delay <= 3600 * 1000)
+
+    def _sijax_post(self, helper, func_name, args='[]'):
+        cls_sijax = helper._sijax.__class__
+        helper._sijax.set_data({cls_sijax.PARAM_REQUEST: func_name, cls_sijax.PARAM_ARGS: args})
+
+    def test_regular_callbacks_exceeding_their_timeout_are_abandoned(self):
+        import threading
+        from sijax.helper import json
+
+        app = flask.Flask(__name__)
+        helper = flask_sijax.Sijax(app)
+        event = threading.Event()
+
+        def callback(obj_response, wait):
+            flask.request.form # the request is still accessible from the pool
+            event.wait(wait)
+
+        with app.test_request_context():
+            app.preprocess_request()
+
+            helper.register_callback('test', callback, timeout=0.05)
+
+            self._sijax_post(helper, 'test', '[0]')
+            commands = json.loads(helper.process_request().get_data(True))
+            self.assertEqual([], commands)
+
+            self._sijax_post(helper, 'test', '[5]')
+            commands = json.loads(helper.process_request().get_data(True))
+            event.set()
+            self.assertEqual(1, len(commands))
+            self.assertTrue('took too long' in commands[0]['alert'])
+
+            # Bad arguments are still detected as an invalid call
+            self._sijax_post(helper, 'test', '[1, 2]')
+            commands = json.loads(helper.process_request().get_data(True))
+            self.assertTrue('wrong way' in commands[0]['alert'])
+
+    def test_calls_are_rejected_as_busy_while_abandoned_callbacks_hold_all_threads(self):
+        import threading
+        import time
+        from sijax.helper import json
+
+        app = flask.Flask(__name__)
+        app.config['SIJAX_TIMEOUT_WORKERS'] = 1
+        helper = flask_sijax.Sijax(app)
+        release, finished = threading.Event(), threading.Event()
+
+        def callback(obj_response, wait):
+            obj_response.alert('before')
+            if wait:
+                release.wait(5)
+                obj_response.alert('after')
+                finished.set()
+
+        with app.test_request_context():
+            app.preprocess_request()
+            helper.register_callback('test', callback, timeout=0.05)
+
+            self._sijax_post(helper, 'test', '[true]')
+            commands = json.loads(helper.process_request().get_data(True))
+            self.assertEqual(1, len(commands))
+            self.assertTrue('took too long' in commands[0]['alert'])
+
+            # The only thread is taken by the abandoned call
+            self._sijax_post(helper, 'test', '[false]')
+            commands = json.loads(helper.process_request().get_data(True))
+            self.assertEqual(['test', [False], 500, 'request'], commands[0]['params'])
+
+            # The abandoned call doesn't touch the responses of others
+            release.set()
+            finished.wait(5)
+            time.sleep(0.05)
+            self._sijax_post(helper, 'test', '[false]')
+            commands = json.loads(helper.process_request().get_data(True))
+            self.assertEqual([{'type': 'alert', 'alert': 'before'}], commands)
+
+    def test_global_timeout_config_is_used(self):
+        from sijax.helper import json
+
+        app = flask.Flask(__name__)
+        app.config['SIJAX_CALLBACK_TIMEOUT'] = 0.01
+        helper = flask_sijax.Sijax(app)
+
+        def callback(obj_response):
+            import time
+            time.sleep(0.2)
+
+        with app.test_request_context():
+            app.preprocess_request()
+            helper.register_callback('test', callback)
+            self._sijax_post(helper, 'test')
+            commands = json.loads(helper.process_request().get_data(True))
+            self.assertTrue('took too long' in commands[0]['alert'])
+
+    def test_coroutine_callbacks_are_cancelled_on_timeout(self):
+        import asyncio
+        from sijax.helper import json
+
+        app = flask.Flask(__name__)
+        helper = flask_sijax.Sijax(app)
+        call_history = []
+
+        async def callback(obj_response, wait):
+            try:
+                await asyncio.sleep(wait)
+                obj_response.alert('done')
+            except asyncio.CancelledError:
+                call_history.append('cancelled')
+                raise
+
+        with app.test_request_context():
+            app.preprocess_request()
+            helper.register_callback('test', callback, timeout=0.05)
+
+            self._sijax_post(helper, 'test', '[0]')
+            commands = json.loads(helper.process_request().get_data(True))
+            self.assertEqual('done', commands[0]['alert'])
+
+            self._sijax_post(helper, 'test', '[5]')
+            commands = json.loads(helper.process_request().get_data(True))
+            self.assertTrue('took too long' in commands[0]['alert'])
+            self.assertEqual(['cancelled'], call_history)
+
+    def test_streaming_callbacks_are_checked_between_yields_and_stop_on_close(self):
+        import time
+
+        app = flask.Flask(__name__)
+        helper = flask_sijax.Sijax(app)
+        call_history = []
+
+        def callback(obj_response, sleep_time):
+            try:
+                for i in range(3):
+                    obj_response.html('#progress', 'step %d' % i)
+                    call_history.append(i)
+                    yield obj_response
+                    time.sleep(sleep_time)
+            finally:
+                call_history.append('closed')
+
+        with app.test_request_context():
+            app.preprocess_request()
+            helper.register_comet_callback('test', callback, timeout=0.1)
+
+            self._sijax_post(helper, 'test', '[0]')
+            response = helper.process_request()
+            body = b''.join(response.response).decode('utf-8')
+            self.assertTrue('step 2' in body)
+            self.assertEqual([0, 1, 2, 'closed'], call_history)
+
+            del call_history[:]
+            response = helper.process_request()
+            iterator = iter(response.response)
+            self.assertTrue('step 0' in next(iterator).decode('utf-8'))
+            response.close()
+            self.assertEqual([0, 'closed'], call_history)
+
+            del call_history[:]
+            self._sijax_post(helper, 'test', '[0.06]')
+            body = b''.join(helper.process_request().response).decode('utf-8')
+            self.assertTrue('took too long' in body)
+            # Stopped when yielding after the deadline, instead of resuming,
+            # and what it did after the deadline is not sent
+            self.assertEqual([0, 1, 2, 'closed'], call_history)
+            self.assertTrue('step 1' in body)
+            self.assertFalse('step 2' in body)
+
+    def test_importing_the_extension_does_not_import_sijax(self):
+        import subprocess, sys
+
+        code = 'import sys, flask_sijax; sys.exit("sijax" in sys.modules)'
+        self.assertEqual(0, subprocess.call([sys.executable, '-c', code]))
+
+    def test_deploy_static_files_only_writes_when_needed(self):
+        import os, shutil, tempfile
+        from sijax.exception import SijaxError
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            static_path = os.path.join(tmp_dir, 'sijax')
+            self.assertTrue(flask_sijax.deploy_static_files(static_path))
+            for file_name in ('sijax.js', 'json2.js', 'sijax_comet.js', 'sijax_upload.js'):
+                self.assertTrue(os.path.exists(os.path.join(static_path, file_name)))
+            self.assertFalse(flask_sijax.deploy_static_files(static_path))
+
+            # Unchanged files are left alone, changed ones are replaced
+            sijax_js = os.path.join(static_path, 'sijax.js')
+            json2_js = os.path.join(static_path, 'json2.js')
+            with open(sijax_js, 'w') as fp:
+                fp.write('modified')
+            json2_inode = os.stat(json2_js).st_ino
+            os.unlink(os.path.join(static_path, 'sijax_version'))
+            with open(os.path.join(static_path, 'sijax_version'), 'w') as fp:
+                fp.write('0.1.0')
+            self.assertTrue(flask_sijax.deploy_static_files(static_path))
+            with open(sijax_js) as fp:
+                self.assertTrue('Sijax.request' in fp.read())
+            self.assertEqual(json2_inode, os.stat(json2_js).st_ino)
+
+            # Deleted or truncated files are deployed again
+            os.unlink(sijax_js)
+            self.assertTrue(flask_sijax.deploy_static_files(static_path))
+            self.assertTrue(os.path.exists(sijax_js))
+            open(json2_js, 'w').close()
+            self.assertTrue(flask_sijax.deploy_static_files(static_path))
+            self.assertNotEqual(0, os.path.getsize(json2_js))
+            self.assertFalse(flask_sijax.deploy_static_files(static_path))
+
+            # Directories with other files in them are not touched
+            user_path = os.path.join(tmp_dir, 'user')
+            os.makedirs(user_path)
+            with open(os.path.join(user_path, 'file.js'), 'w') as fp:
+                fp.write('')
+            self.assertRaises(SijaxError, flask_sijax.deploy_static_files, user_path)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_static_files_deployment_can_be_left_to_the_cli(self):
+        import os, shutil, tempfile
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            app = flask.Flask(__name__)
+            app.config['SIJAX_STATIC_PATH'] = tmp_dir
+            app.config['SIJAX_STATIC_DEPLOY'] = False
+            flask_sijax.Sijax(app)
+            self.assertEqual([], os.listdir(tmp_dir))
+
+            result = app.test_cli_runner().invoke(args=['sijax', 'deploy-static'])
+            self.assertEqual(0, result.exit_code)
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir, 'sijax.js')))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_bootstrap_bundles_are_built_for_the_sijax_routes(self):
+        import json, os, shutil, tempfile
+
+        app = flask.Flask(__name__)
+        app.config['SIJAX_JSON_URI'] = '/static/json2.js'
+        flask_sijax.Sijax(app)
+
+        def index():
+            return ''
+
+        def user(user_id):
+            return ''
+
+        admin = flask.Blueprint('admin', __name__)
+        flask_sijax.SijaxRegistry(admin, request_uri='/admin/sijax')
+        flask_sijax.route(admin, '/')(index)
+        flask_sijax.route(app, '/')(index)
+        flask_sijax.route(app, '/users/<int:user_id>')(user)
+        app.route('/about', endpoint='about')(index)
+        app.register_blueprint(admin, url_prefix='/admin')
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            result = app.test_cli_runner().invoke(args=['sijax', 'build', tmp_dir])
+            self.assertEqual(0, result.exit_code)
+            self.assertTrue('2 bundle(s) for 3 route(s)' in result.output)
+
+            with open(os.path.join(tmp_dir, 'manifest.json')) as fp:
+                manifest = json.load(fp)
+            self.assertEqual(['/', '/admin/', '/users/<int:user_id>'], sorted(manifest))
+            self.assertEqual(manifest['/'], manifest['/users/<int:user_id>'])
+            self.assertNotEqual(manifest['/'], manifest['/admin/'])
+
+            with open(os.path.join(tmp_dir, manifest['/'])) as fp:
+                js = fp.read()
+            self.assertTrue('Sijax.setRequestUri = function' in js)
+            self.assertTrue('data-sijax-uri' in js)
+            self.assertTrue('Sijax.setJsonUri("/static/json2.js");' in js)
+            self.assertTrue(js.endswith(flask_sijax._CLIENT_JS))
+
+            with open(os.path.join(tmp_dir, manifest['/admin/'])) as fp:
+                self.assertTrue('||"/admin/sijax"||' in fp.read())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_assets_are_served_from_memory_with_fingerprinted_urls(self):
+        import gzip
+
+        app = flask.Flask(__name__)
+        app.config['SIJAX_SERVE_ASSETS'] = True
+        flask_sijax.Sijax(app)
+
+        with app.test_request_context():
+            app.preprocess_request()
+            url = flask.render_template_string("{{ sijax_asset_url('sijax.js') }}")
+            self.assertTrue(url.startswith('/_sijax/sijax.'))
+            self.assertTrue(url.endswith('.js'))
+            # json2.js is served too, so it can be used without any configuration
+            self.assertTrue(flask_sijax.sijax_asset_url('json2.js') in flask.g.sijax.get_js())
+
+        client = app.test_client()
+
+        response = client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(b'Sijax.request' in response.data)
+        self.assertTrue('immutable' in response.headers['Cache-Control'])
+        etag = response.headers['ETag']
+
+        response = client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+
+        response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertTrue(b'Sijax.request' in gzip.decompress(response.data))
+        self.assertNotEqual(etag, response.headers['ETag'])
+
+        response = client.get('/_sijax/sijax.js')
+        self.assertEqual('no-cache', response.headers['Cache-Control'])
+
+        self.assertEqual(404, client.get('/_sijax/missing.js').status_code)
+
+    def test_register_object_finds_callables_once_per_class(self):
+        app = flask.Flask(__name__)
+        helper = flask_sijax.Sijax(app)
+
+        class Handlers(object):
+            def first(self, obj_response):
+                pass
+
+            def _private(self, obj_response):
+                pass
+
+        def registered_names(obj):
+            with app.test_request_context():
+                app.preprocess_request()
+                helper.register_object(obj)
+                return sorted(helper._sijax._callbacks)
+
+        self.assertEqual(['first'], registered_names(Handlers()))
+        self.assertEqual(['first'], registered_names(Handlers))
+
+        # Changing the class invalidates what was found before
+        Handlers.second = lambda self, obj_response: None
+        self.assertEqual(['first', 'second'], registered_names(Handlers()))
+        del Handlers.first
+        self.assertEqual(['second'], registered_names(Handlers()))
+
+        # Callables stored on the instance are found too
+        handlers = Handlers()
+        handlers.third = lambda obj_response: None
+        self.assertEqual(['second', 'third'], registered_names(handlers))
+
+        # So are methods replaced (or marked) since they were found
+        Handlers.second = flask_sijax.sijax_callback('renamed')(lambda self, obj_response: None)
+        self.assertEqual(['renamed'], registered_names(Handlers()))
+        def fourth(self, obj_response):
+            pass
+        Handlers.second = fourth
+        self.assertEqual(['second'], registered_names(Handlers()))
+        flask_sijax.sijax_callback('marked')(fourth)
+        self.assertEqual(['marked'], registered_names(Handlers()))
+
+        # Properties are looked up on the instance, like Sijax does
+        class WithProperty(object):
+            @property
+            def dynamic(self):
+                return lambda obj_response: None
+        self.assertEqual(['dynamic'], registered_names(WithProperty()))
+
+    def test_register_object_honors_markers_and_manifests(self):
+        app = flask.Flask(__name__)
+        helper = flask_sijax.Sijax(app)
+
+        class Marked(object):
+            @flask_sijax.sijax_callback
+            def save(self, obj_response):
+                pass
+
+            @staticmethod
+            @flask_sijax.sijax_callback('clear')
+            def clear_messages(obj_response):
+                pass
+
+            def helper(self):
+                pass
+
+        class WithManifest(object):
+            __sijax_callbacks__ = {'go': 'run'}
+
+            def run(self, obj_response):
+                pass
+
+            def other(self, obj_response):
+                pass
+
+        with app.test_request_context():
+            app.preprocess_request()
+            helper.register_object(Marked())
+            self.assertEqual(['clear', 'save'], sorted(helper._sijax._callbacks))
+
+        with app.test_request_context():
+            app.preprocess_request()
+            helper.register_comet_object(WithManifest())
+            self.assertEqual(['go'], sorted(helper._sijax._callbacks))
+
+    def test_render_fragment_caches_fragments_and_skips_those_the_client_has(self):
+        import jinja2
+        from sijax.helper import json
+
+        app = flask.Flask(__name__)
+        app.jinja_loader = jinja2.DictLoader({'fragment.html': '<b>{{ render() }}</b>'})
+        helper = flask_sijax.Sijax(app)
+
+        render_history = []
+
+        def render():
+            render_history.append('render')
+            return 'news'
+
+        def callback(obj_response):
+            helper.render_fragment(obj_response, '#news', 'fragment.html',
+                                   cache_key='news', render=render)
+
+        def call(data=None):
+            with app.test_request_context(method='POST', data=data or {}):
+                app.preprocess_request()
+                helper.register_callback('test', callback)
+                self._sijax_post(helper, 'test')
+                return json.loads(helper.process_request().get_data(True))
+
+        commands = call()
+        self.assertEqual('Sijax.fragment', commands[0]['call'])
+        selector, html, version = commands[0]['params']
+        self.assertEqual(('#news', '<b>news</b>'), (selector, html))
+
+        # Rendered once only
+        self.assertEqual(commands, call())
+        self.assertEqual(['render'], render_history)
+
+        # Nothing but the version is sent when the client has the fragment
+        commands = call({flask_sijax.PARAM_FRAGMENTS: 'other,%s' % version})
+        self.assertEqual(['#news', None, version], commands[0]['params'])
+
+        app.extensions['sijax_state'].fragment_cache.clear()
+        call()
+        self.assertEqual(['render', 'render'], render_history)
+
+    def test_fragment_cache_evicts_expired_and_least_recently_used_entries(self):
+        cache = flask_sijax._FragmentCache(2)
+        cache.set('a', 1, None)
+        cache.set('b', 2, None)
+        self.assertEqual(1, cache.get('a'))
+        cache.set('c', 3, None)
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        cache.set('d', 4, -1)
+        self.assertEqual(None, cache.get('d'))
+
+    def test_keyed_list_sends_only_the_changes(self):
+        import random
+
+        def apply_ops(elements, ops):
+            # Mimics what `Sijax.patchList` does in the browser
+            elements = list(elements)
+            index = lambda key: [k for k, _ in elements].index(key)
+            def place(element, after):
+                elements.insert(0 if after is None else index(after) + 1, element)
+            for op in ops:
+                if op[0] == 'reset':
+                    elements = [tuple(item) for item in op[1]]
+                elif op[0] == 'remove':
+                    del elements[index(op[1])]
+                elif op[0] == 'update':
+                    elements[index(op[1])] = (op[1], op[2])
+                elif op[0] == 'insert':
+                    place((op[1], op[2]), op[3])
+                elif op[0] == 'move':
+                    place(elements.pop(index(op[1])), op[2])
+            return elements
+
+        keyed_list = flask_sijax.KeyedList('#rows')
+        items = [(str(i), '<li>%d</li>' % i) for i in range(5)]
+        ops = keyed_list.diff(items)
+        self.assertEqual([['reset', [list(item) for item in items]]], ops)
+
+        self.assertEqual([], keyed_list.diff(items))
+
+        items[2] = ('2', '<li>changed</li>')
+        items.append(('5', '<li>5</li>'))
+        del items[0]
+        ops = keyed_list.diff(items)
+        self.assertEqual([['remove', '0'], ['update', '2', '<li>changed</li>'],
+                          ['insert', '5', '<li>5</li>', '4']], ops)
+
+        # Moving a single element around is a single operation
+        items.insert(0, items.pop())
+        self.assertEqual([['move', '5', None]], keyed_list.diff(items))
+
+        # The state can be carried over to another object (and request)
+        restored = flask_sijax.KeyedList('#rows', state=keyed_list.state)
+        self.assertEqual([], restored.diff(items))
+
+        rnd = random.Random(42)
+        elements = items
+        for _ in range(200):
+            keys = rnd.sample(range(30), rnd.randint(0, 20))
+            new_items = [(str(k), '<li>%d</li>' % rnd.randint(0, 2)) for k in keys]
+            elements = apply_ops(elements, keyed_list.diff(new_items))
+            self.assertEqual(new_items, elements)
+
+    def test_keyed_list_update_adds_a_single_command(self):
+        from sijax.helper import json
+
+        app = flask.Flask(__name__)
+        helper = flask_sijax.Sijax(app)
+        keyed_list = flask_sijax.KeyedList('#rows')
+
+        def callback(obj_response):
+            keyed_list.update(obj_response, [('a', '<li>a</li>')])
+
+        with app.test_request_context():
+            app.preprocess_request()
+            helper.register_callback('test', callback)
+            self._sijax_post(helper, 'test')
+
+            commands = json.loads(helper.process_request().get_data(True))
+            self.assertEqual(['#rows', [['reset', [['a', '<li>a</li>']]]]], commands[0]['params'])
+            commands = json.loads(helper.process_request().get_data(True))
+            self.assertEqual([], commands)
+
+    def test_streams_limit_buffered_commands(self):
+        app = flask.Flask(__name__)
+        app.config['SIJAX_STREAM_BUFFER_LIMIT'] = 1000
+        helper = flask_sijax.Sijax(app)
+
+        def callback(obj_response, count):
+            for i in range(count):
+                obj_response.html('#a', 'x' * 100)
+            self.assertEqual('[%d]' % count, helper._sijax.get_data()['sijax_args'])
+            yield obj_response
+            for i in range(count):
+                obj_response.html('#a', 'x' * 100)
+
+        with app.test_request_context():
+            app.preprocess_request()
+            helper.register_comet_callback('test', callback)
+
+            # Flushing resets the size of the buffer
+            self._sijax_post(helper, 'test', '[5]')
+            body = b''.join(helper.process_request().response)
+            self.assertEqual(10, body.count(b'x' * 100))
+
+            self._sijax_post(helper, 'test', '[20]')
+            response = helper.process_request()
+            self.assertRaises(flask_sijax.BufferLimitError, b''.join, response.response)
+
+    def _create_streaming_app(self, handler):
+        app = flask.Flask(__name__)
+        flask_sijax.Sijax(app)
+
+        @flask_sijax.route(app, '/')
+        def index():
+            flask.g.sijax.register_comet_callback('stream', handler)
+            flask.g.sijax.register_upload_callback('form', handler)
+            return flask.g.sijax.process_request()
+
+        return app
+
+    def test_streams_can_access_the_request_until_closed(self):
+        import io
+
+        def handler(obj_response, files, form_values):
+            obj_response.html('#a', 'first')
+            yield obj_response
+            obj_response.html('#a', files['file'].read().decode('utf-8'))
+            obj_response.html('#b', flask.request.form['field'])
+
+        app = self._create_streaming_app(handler)
+        client = app.test_client()
+        data = {'sijax_rq': 'form_upload', 'sijax_args': '["form"]', 'field': 'value',
+                'file': (io.BytesIO(b'file contents'), 'file.txt')}
+        response = client.post('/', data=data, buffered=False)
+        body = b''.join(response.response)
+        response.close()
+
+        self.assertTrue(b'first' in body)
+        self.assertTrue(b'file contents' in body)
+        self.assertTrue(b'value' in body)
+        self.assertFalse(flask.has_request_context())
+
+    def test_streams_can_release_the_request_data_before_closing(self):
+        import gc, io, weakref
+
+        released = []
+
+        def handler(obj_response, files, form_values):
+            released.extend([weakref.ref(files), weakref.ref(files['file']),
+                             weakref.ref(flask.request.form)])
+            obj_response.html('#a', files['file'].read().decode('utf-8'))
+            obj_response.release_request_data()
+            del files, form_values
+            yield obj_response
+            obj_response.html('#b', 'form: %d' % len(flask.request.form))
+
+        app = self._create_streaming_app(handler)
+        data = {'sijax_rq': 'form_upload', 'sijax_args': '["form"]', 'field': 'value',
+                'file': (io.BytesIO(b'file contents'), 'file.txt')}
+        response = app.test_client().post('/', data=data, buffered=False)
+        iterator = iter(response.response)
+        self.assertTrue(b'file contents' in next(iterator))
+
+        # The stream is still open, but the form and files are gone
+        gc.collect()
+        self.assertEqual([None, None, None], [ref() for ref in released])
+        self.assertTrue(b'form: 0' in b''.join(iterator))
+        response.close()
+
+    def test_aborted_streams_do_not_leak_request_contexts_or_memory(self):
+        import gc
+
+        def handler(obj_response):
+            for i in range(100):
+                obj_response.html('#a', 'step %d' % i)
+                yield obj_response
+
+        app = self._create_streaming_app(handler)
+        client = app.test_client()
+        data = {'sijax_rq': 'stream', 'sijax_args': '[]'}
+
+        def open_and_abort_streams(count):
+            for _ in range(count):
+                response = client.post('/', data=data, buffered=False)
+                next(iter(response.response))
+                response.close()
+
+        def count_objects():
+            gc.collect()
+            objects = gc.get_objects()
+            contexts = [obj for obj in objects if isinstance(obj, flask.ctx.RequestContext)]
+            return len(contexts), len(objects)
+
+        open_and_abort_streams(50)
+        contexts_before, objects_before = count_objects()
+        open_and_abort_streams(2000)
+        contexts_after, objects_after = count_objects()
+
+        self.assertEqual(contexts_before, contexts_after)
+        self.assertFalse(flask.has_request_context())
+        # Anything kept alive by each stream would show up thousands of times
+        self.assertTrue(objects_after - objects_before < 500,
+                        'Leaked %d objects' % (objects_after - objects_before))
+
+    def test_profiling_captures_requested_calls_and_serves_the_stats(self):
+        import os, pstats, tempfile
+
+        app = flask.Flask(__name__)
+        app.config['SIJAX_PROFILING'] = True
+        app.config['SIJAX_PROFILING_TOKEN'] = 'secret'
+        app.config['SIJAX_PROFILING_URL'] = '/_profiles'
+        app.config['SIJAX_PROFILING_KEEP'] = 2
+        flask_sijax.Sijax(app)
+
+        def work(obj_response, count):
+            obj_response.html('#a', str(sum(range(count))))
+
+        def stream(obj_response):
+            yield obj_response
+            obj_response.html('#a', 'done')
+
+        @flask_sijax.route(app, '/')
+        def index():
+            flask.g.sijax.register_callback('work', work)
+            flask.g.sijax.register_comet_callback('stream', stream)
+            return flask.g.sijax.process_request()
+
+        client = app.test_client()
+        call = {'sijax_rq': 'work', 'sijax_args': '[1000]'}
+        client.post('/', data=call)
+        client.post('/', data=call, headers={'X-Sijax-Profile': 'wrong'})
+        self.assertEqual(403, client.get('/_profiles/').status_code)
+        self.assertEqual([], client.get('/_profiles/?token=secret').get_json())
+
+        for _ in range(3):
+            client.post('/', data=call, headers={'X-Sijax-Profile': 'secret'})
+        response = client.post('/', data={'sijax_rq': 'stream', 'sijax_args': '[]'},
+                               headers={'X-Sijax-Profile': 'secret'})
+        self.assertTrue(b'done' in response.get_data())
+
+        # Invalid calls are still detected
+        response = client.post('/', data={'sijax_rq': 'work', 'sijax_args': '[]'},
+                               headers={'X-Sijax-Profile': 'secret'})
+        self.assertTrue(b'wrong way' in response.get_data())
+
+        entries = client.get('/_profiles/', headers={'X-Sijax-Profile': 'secret'}).get_json()
+        self.assertEqual(['stream', 'work', 'work'], [e['name'] for e in entries])
+        entries = client.get('/_profiles/?token=secret&name=work').get_json()
+        self.assertEqual(2, len(entries))
+
+        url = '/_profiles/%d.prof' % entries[0]['id']
+        self.assertEqual(403, client.get(url).status_code)
+        response = client.get(url + '?token=secret')
+        self.assertEqual(200, response.status_code)
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, response.get_data())
+            os.close(fd)
+            functions = [key[2] for key in pstats.Stats(path).stats]
+        finally:
+            os.remove(path)
+        self.assertTrue('work' in functions)
+        self.assertEqual(404, client.get('/_profiles/12345.prof?token=secret').status_code)
+
+    def test_arguments_are_validated_and_converted_when_asked_to(self):
+        import datetime
+        import functools
+        from typing import Dict, List, Optional, Tuple, TypeVar
+        from sijax.helper import json
+
+        app = flask.Flask(__name__)
+        helper = flask_sijax.Sijax(app)
+        calls = []
+
+        def handler(obj_response, count: int, tags: List[str], note: Optional[str] = None):
+            calls.append((count, tags, note))
+
+        def stream(obj_response, extra, ratio: float, *flags: bool):
+            calls.append((extra, ratio, flags))
+            yield obj_response
+
+        def untyped(obj_response, a, b=None):
+            calls.append((a, b))
+
+        def call(name, args):
+            self._sijax_post(helper, name, args)
+            body = b''.join(helper.process_request().response).decode('utf-8')
+            return body if name == 'stream' else json.loads(body)
+
+        with app.test_request_context():
+            app.preprocess_request()
+            helper.register_callback('handler', handler, validate=True, timeout=5)
+            helper.register_comet_callback('stream', stream, args_extra=['x'], validate=True)
+            helper.register_callback('untyped', untyped, validate=True)
+            helper.register_callback('unchecked', handler)
+
+            call('handler', '["3", ["a", 2]]')
+            call('handler', '[4.0, [], null]')
+            call('stream', '["0.5", "on", 0]')
+            call('untyped', '[1]')
+            self.assertEqual([(3, ['a', '2'], None), (4, [], None),
+                              ('x', 0.5, (True, False)), (1, None)], calls)
+
+            commands = call('handler', '[1]')
+            self.assertEqual('Sijax.invalidArgs', commands[0]['call'])
+            func_name, errors = commands[0]['params']
+            self.assertEqual('handler', func_name)
+            self.assertEqual([{'argument': None, 'index': None,
+                               'message': 'expected 2 to 3 arguments, got 1'}], errors)
+
+            commands = call('handler', '["many", [null], 5, 6]')
+            self.assertEqual('expected 2 to 3 arguments, got 4', commands[0]['params'][1][0]['message'])
+
+            commands = call('handler', '["many", [null], {}]')
+            self.assertEqual(['count', 'tags', 'note'],
+                             [e['argument'] for e in commands[0]['params'][1]])
+            self.assertEqual('item 0: expected a string, got null', commands[0]['params'][1][1]['message'])
+
+            body = call('stream', '[true]')
+            self.assertTrue('Sijax.invalidArgs' in body)
+            self.assertTrue('expected a number, got boolean' in body)
+
+            # Without validation, arguments are passed as they are
+            call('unchecked', '["3", [1]]')
+            self.assertEqual(5, len(calls))
+            self.assertEqual(('3', [1], None), calls[-1])
+
+            def unsupported(obj_response, value: Dict[str, TypeVar('T')]):
+                pass
+            self.assertRaises(TypeError, helper.register_callback,
+                              'unsupported', unsupported, validate=True)
+
+            # Nothing JSON decodes to is a datetime
+            def not_json(obj_response, when: datetime.datetime):
+                pass
+            self.assertRaises(TypeError, helper.register_callback,
+                              'not_json', not_json, validate=True)
+
+            # Tuples are made from arrays
+            def pairs(obj_response, pair: Tuple[int, str], rest: Tuple[float, ...], anything: tuple):
+                calls.append((pair, rest, anything))
+
+            helper.register_callback('pairs', pairs, validate=True)
+            call('pairs', '[["1", 2], [1, "2.5"], [null]]')
+            self.assertEqual(((1, '2'), (1.0, 2.5), (None,)), calls[-1])
+            commands = call('pairs', '[[1], [], []]')
+            self.assertEqual('expected an array of 2 items, got 1', commands[0]['params'][1][0]['message'])
+            commands = call('pairs', '[[1, "a"], ["x"], []]')
+            self.assertEqual('item 0: expected a number, got "x"', commands[0]['params'][1][0]['message'])
+
+            # Callable objects and partials have their hints looked up too
+            class Handler(object):
+                def __call__(self, obj_response, count: int):
+                    calls.append(count)
+
+            def with_db(db, obj_response, count: int):
+                calls.append((db, count))
+
+            helper.register_callback('object', Handler(), validate=True)
+            helper.register_callback('partial', functools.partial(with_db, 'db'), validate=True)
+            call('object', '["6"]')
+            call('partial', '["7"]')
+            self.assertEqual([6, ('db', 7)], calls[-2:])
+            self.assertEqual('Sijax.invalidArgs', call('partial', '["x"]')[0]['call'])
+
+        # Validators are worked out once per function
+        validator = flask_sijax._validators_cache[handler][(0, False)]
+        with app.test_request_context():
+            app.preprocess_request()
+            helper.register_callback('handler', handler, validate=True)
+            self.assertTrue(validator is flask_sijax._validators_cache[handler][(0, False)])
+
+    def test_blueprint_registries_are_resolved_by_endpoint(self):
+        import io
+
+        calls = []
+
+        def save(obj_response, value):
+            calls.append(('save', value))
+            obj_response.alert('saved')
+
+        def upload(obj_response, files, form_values):
+            calls.append(('upload', files['file'].read()))
+            yield obj_response
+
+        admin = flask.Blueprint('admin', __name__)
+        admin_sijax = flask_sijax.SijaxRegistry(admin, json_uri='/admin/json2.js')
+        admin_sijax.register_callback('save', save)
+        upload_js = admin_sijax.register_upload_callback('form', upload)
+        self.assertTrue('sjxUpload.registerForm' in upload_js)
+
+        reports = flask.Blueprint('reports', __name__)
+        reports_sijax = flask_sijax.SijaxRegistry(reports, request_uri='/admin/reports/sijax')
+        reports_sijax.register_callback('save', lambda obj_response, value: calls.append(('report', value)))
+
+        def view():
+            if flask.g.sijax.is_sijax_request:
+                return flask.g.sijax.process_request()
+            return flask.g.sijax.get_js()
+
+        flask_sijax.route(admin, '/')(view)
+        flask_sijax.route(reports, '/')(view)
+        admin.register_blueprint(reports, url_prefix='/reports')
+
+        helper = flask_sijax.Sijax()
+        apps = []
+        for json_uri in ('/one/json2.js', '/two/json2.js'):
+            app = flask.Flask(__name__)
+            app.config['SIJAX_JSON_URI'] = json_uri
+            helper.init_app(app)
+            app.register_blueprint(admin, url_prefix='/admin')
+            flask_sijax.route(app, '/')(view)
+            apps.append(app)
+
+        one, two = [app.test_client() for app in apps]
+        save_call = {'sijax_rq': 'save', 'sijax_args': '[1]'}
+        self.assertTrue(b'saved' in one.post('/admin/', data=save_call).data)
+        self.assertTrue(b'saved' in two.post('/admin/', data=save_call).data)
+        one.post('/admin/reports/', data=save_call)
+        self.assertTrue(b'unavailable' in one.post('/', data=save_call).data)
+        self.assertEqual([('save', 1), ('save', 1), ('report', 1)], calls)
+
+        data = {'sijax_rq': 'form_upload', 'sijax_args': '["form"]',
+                'file': (io.BytesIO(b'contents'), 'file.txt')}
+        one.post('/admin/', data=data).close()
+        self.assertEqual(('upload', b'contents'), calls[-1])
+
+        # JS settings come from the blueprint, the app config otherwise
+        self.assertTrue(b'Sijax.setJsonUri("/one/json2.js")' in one.get('/').data)
+        self.assertTrue(b'Sijax.setJsonUri("/two/json2.js")' in two.get('/').data)
+        js = one.get('/admin/reports/').data
+        self.assertTrue(b'Sijax.setJsonUri("/admin/json2.js")' in js)
+        self.assertTrue(b'Sijax.setRequestUri("/admin/reports/sijax")' in js)
+
+        # Functions are registered once for each app
+        states = [app.extensions['sijax_state'] for app in apps]
+        self.assertFalse(states[0] is states[1])
+        self.assertTrue(states[0].get_registry(admin_sijax) is states[0].get_registry(admin_sijax))
+        self.assertFalse(states[0].get_registry(admin_sijax) is states[1].get_registry(admin_sijax))
+
+        # Functions registered during the request take precedence
+        with apps[0].test_request_context('/admin/', method='POST', data=save_call):
+            apps[0].preprocess_request()
+            helper.register_callback('save', lambda obj_response, value: calls.append(('own', value)))
+
+            # ..and requests to other apps don't get in the way
+            with apps[1].test_request_context('/', method='POST', data=save_call):
+                apps[1].preprocess_request()
+                self.assertTrue(b'unavailable' in helper.process_request().get_data())
+
+            helper.process_request()
+            self.assertEqual(('own', 1), calls[-1])
+
+        # Functions registered after the registry was first used are picked up
+        admin_sijax.register_callback('late', lambda obj_response: calls.append('late'))
+        one.post('/admin/', data={'sijax_rq': 'late', 'sijax_args': '[]'})
+        self.assertEqual('late', calls[-1])
+
+        self.assertTrue(apps[0].extensions['sijax'] is helper)
+
+    def test_retried_calls_get_the_response_of_the_original_call(self):
+        import threading
+        import time
+
+        calls = []
+        started, release = threading.Event(), threading.Event()
+
+        def save(obj_response, value):
+            calls.append(value)
+            if value == 'slow':
+                started.set()
+                release.wait(5)
+            if value == 'broken':
+                raise ValueError(value)
+            obj_response.alert('saved %s #%d' % (value, len(calls)))
+
+        app = flask.Flask(__name__)
+        app.config['SIJAX_IDEMPOTENCY_TTL'] = 60
+        app.testing = True
+        flask_sijax.Sijax(app)
+
+        @flask_sijax.route(app, '/')
+        def index():
+            flask.g.sijax.register_callback('save', save)
+            return flask.g.sijax.process_request()
+
+        def post(value, key, session='user-1'):
+            data = {'sijax_rq': 'save', 'sijax_args': '["%s"]' % value}
+            if key is not None:
+                data['sijax_key'] = key
+            client = app.test_client()
+            client.set_cookie('session', session)
+            return client.post('/', data=data).data
+
+        first = post('a', 'key-1')
+        self.assertTrue(b'saved a #1' in first)
+        self.assertEqual(first, post('a', 'key-1'))
+        self.assertTrue(b'saved a #2' in post('a', 'key-2'))
+        self.assertTrue(b'saved b #3' in post('b', 'key-1'))
+        self.assertTrue(b'saved a #4' in post('a', None))
+        self.assertTrue(b'saved a #5' in post('a', None))
+
+        # Failed calls are not kept, so retrying them runs them again
+        self.assertRaises(ValueError, post, 'broken', 'key-3')
+        self.assertRaises(ValueError, post, 'broken', 'key-3')
+        self.assertEqual(7, len(calls))
+
+        # Retries arriving while the original call is running wait for it
+        responses = []
+        original = threading.Thread(target=lambda: responses.append(post('slow', 'key-4')))
+        original.start()
+        started.wait(5)
+        retry = threading.Thread(target=lambda: responses.append(post('slow', 'key-4')))
+        retry.start()
+        time.sleep(0.1)
+        release.set()
+        original.join(5)
+        retry.join(5)
+        self.assertEqual(2, len(responses))
+        self.assertEqual(responses[0], responses[1])
+        self.assertEqual(8, len(calls))
+
+        # The same key sent by another user runs the function for them
+        self.assertTrue(b'saved a #9' in post('a', 'key-1', session='user-2'))
+
+        # Retries giving up on waiting are told to come back with the same key
+        started.clear()
+        release.clear()
+        app.extensions['sijax_state'].idempotency_wait = 0.05
+        original = threading.Thread(target=lambda: post('slow', 'key-5'))
+        original.start()
+        started.wait(5)
+        busy = post('slow', 'key-5')
+        release.set()
+        original.join(5)
+        self.assertTrue(b'"Sijax.busy","params":["save",["slow"],500,"request","key-5"]' in busy)
+        self.assertEqual(10, len(calls))
+
+        # Calls without a configured TTL are never kept
+        app = flask.Flask(__name__)
+        flask_sijax.Sijax(app)
+        self.assertTrue(app.extensions['sijax_state'].idempotency_store is None)
+
+    def test_local_idempotency_store(self):
+        import threading
+
+        store = flask_sijax.LocalIdempotencyStore()
+
+        self.assertTrue(store.add('key', '', 60))
+        self.assertFalse(store.add('key', '', 60))
+        self.assertEqual('', store.wait('key', 0.01))
+        threading.Timer(0.05, store.set, ('key', 'response', 60)).start()
+        self.assertEqual('response', store.wait('key', 5))
+        store.delete('key')
+        self.assertEqual(None, store.get('key'))
+
+        self.assertTrue(store.add('expired', 'response', -1))
+        self.assertEqual(None, store.get('expired'))
+        self.assertTrue(store.add('expired', 'response', 60))
+
+    def test_shared_memory_cache(self):
+        import os, shutil, subprocess, sys, tempfile
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'cache')
+            cache = flask_sijax.SharedMemoryCache(path, max_entries=2,
+                                                  max_value_size=64, ways=2)
+
+            cache.set(('template.html', 'a'), ('<b>a</b>', 'v1'))
+            cache.set('b', 'B')
+            self.assertEqual(('<b>a</b>', 'v1'), cache.get(('template.html', 'a')))
+            cache.set('c', 'C') # evicts "b", the least recently used one
+            self.assertEqual(None, cache.get('b'))
+            self.assertEqual('C', cache.get('c'))
+
+            self.assertFalse(cache.set('c', 'x' * 100))
+            self.assertEqual(None, cache.get('c'))
+            self.assertTrue(cache.set('expired', 'E', -1))
+            self.assertEqual(None, cache.get('expired'))
+            self.assertTrue(cache.add('expired', '', 60))
+            self.assertFalse(cache.add('expired', '', 60))
+            cache.delete('expired')
+            self.assertEqual(None, cache.get('expired'))
+
+            # Other processes see the same entries
+            code = ('import flask_sijax; cache = flask_sijax.SharedMemoryCache(%r, 2, 64, 2); '
+                    'cache.set("child", cache.get(("template.html", "a")))' % path)
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(flask_sijax.__file__)))
+            subprocess.check_call([sys.executable, '-c', code], env=env)
+            self.assertEqual(('<b>a</b>', 'v1'), cache.get('child'))
+
+            # In-flight markers are never evicted
+            cache.clear()
+            self.assertTrue(cache.add('call-1', '', 60))
+            self.assertTrue(cache.add('call-2', '', 60))
+            self.assertFalse(cache.set('c', 'C'))
+            self.assertTrue(cache.add('call-3', '', 60))
+            self.assertEqual(None, cache.get('call-3'))
+            self.assertEqual('', cache.get('call-1'))
+            self.assertTrue(cache.set('call-1', 'response', 60))
+            self.assertTrue(cache.set('c', 'C'))
+            self.assertEqual('', cache.get('call-2'))
+            self.assertEqual(None, cache.get('call-1'))
+
+            # Forked processes reopen the file, closing what they inherited
+            cache.set('b', 'B')
+            pid = os.fork()
+            if not pid:
+                inherited = cache._mmap
+                os._exit(0 if cache.get('b') == 'B' and inherited.closed else 1)
+            self.assertEqual(0, os.waitpid(pid, 0)[1])
+
+            cache.clear()
+            self.assertEqual(None, cache.get('child'))
+
+            # Values that can't be decoded are misses
+            cache.set('corrupt', 'C')
+            digest, set_index = cache._locate('corrupt')
+            found, _ = cache._find(cache._header.size + set_index * cache.ways * cache._slot_size,
+                                   digest, 0)
+            cache._mmap[found + cache._entry.size] = 0xff
+            self.assertEqual(None, cache.get('corrupt'))
+            cache.set('b', 'B')
+
+            # Replaced by a new file if the sizes change, while
+            # the processes using the old one keep it as it is
+            old_cache = cache
+            cache = flask_sijax.SharedMemoryCache(path, max_entries=16)
+            self.assertEqual(None, cache.get('b'))
+            self.assertEqual(os.path.getsize(path), cache._size)
+            self.assertEqual('B', old_cache.get('b'))
+            self.assertNotEqual(os.stat(path).st_ino, os.fstat(old_cache._fd).st_ino)
+            self.assertEqual([os.path.basename(path)], os.listdir(tmp_dir))
+
+            app = flask.Flask(__name__)
+            app.config['SIJAX_FRAGMENT_CACHE'] = cache
+            app.config['SIJAX_IDEMPOTENCY_TTL'] = 60
+            app.config['SIJAX_IDEMPOTENCY_STORE'] = cache
+            flask_sijax.Sijax(app)
+            self.assertTrue(app.extensions['sijax_state'].fragment_cache is cache)
+            self.assertTrue(app.extensions['sijax_state'].idempotency_store is cache)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_local_limit_store(self):
+        store = flask_sijax.LocalLimitStore()
+
+        self.assertTrue(store.acquire('key', 2))
+        self.assertTrue(store.acquire('key', 2))
+        self.assertFalse(store.acquire('key', 2))
+        store.release('key', 2)
+        self.assertTrue(store.acquire('key', 2))
+
+        self.assertEqual(1, store.incr('counter', 60))
+        self.assertEqual(2, store.incr('counter', 60))
+        self.assertEqual(1, store.incr('counter-expired', -1))
+        self.assertEqual(1, store.incr('counter-expired', -1))
+
+
 if __name__ == '__main__':
     unittest.main()